@@ -1,18 +1,21 @@
-from flask import Flask, request, Response
-from twilio.twiml.voice_response import VoiceResponse, Dial
+from flask import Flask, Blueprint, request, Response, current_app, g
+from twilio.twiml.voice_response import VoiceResponse
 from dotenv import load_dotenv
 import os
 import logging
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-import time
-import re
-import json
 import threading
-from datetime import datetime, timedelta
-
-# File to store processed calls
+import time
+from call_queue import CallEventQueue
+from hubspot_client import HubSpotClient, SharedTokenBucket, HUBSPOT_BASE_URL, DEFAULT_RATE_PER_SECOND, DEFAULT_BURST
+from contact_cache import ContactCache, SqliteContactStore
+from dedupe_store import create_dedupe_store, ExpirySweeper
+from hubspot_batcher import CallBatcher
+from twiml_routing import RoutingCache, DIAL_TIMEOUT, DIAL_TIME_LIMIT
+from call_correlator import CallCorrelator, CALLBACK_GRACE_SECONDS
+import metrics
+import structured_logging
+
+# Legacy file that processed calls were stored in; imported into the dedupe store once
 PROCESSED_CALLS_FILE = "processed_calls.json"
 
 # Maximum number of call SIDs to store per phone number
@@ -21,101 +24,409 @@ MAX_CALLS_PER_NUMBER = 100
 # Number of days to keep call records
 CALL_RECORD_RETENTION_DAYS = 7
 
-# Lock for file access to prevent race conditions
-file_lock = threading.Lock()
-
-# In-memory cache for processed calls
-processed_calls = {}
-
-def load_processed_calls():
-    with file_lock:
-        if os.path.exists(PROCESSED_CALLS_FILE):
-            try:
-                with open(PROCESSED_CALLS_FILE, 'r') as f:
-                    return json.load(f)
-            except:
-                return {}
-        return {}
-
-def save_processed_calls(processed_calls):
-    with file_lock:
-        with open(PROCESSED_CALLS_FILE, 'w') as f:
-            json.dump(processed_calls, f)
-
-def cleanup_old_calls():
-    """Remove call records older than CALL_RECORD_RETENTION_DAYS days and limit the number of calls per phone number."""
-    global processed_calls
-
-    # Get the cutoff timestamp for time-based cleanup
-    cutoff_time = int((datetime.now() - timedelta(days=CALL_RECORD_RETENTION_DAYS)).timestamp() * 1000)
-
-    for phone_number in processed_calls:
-        # Remove call records older than CALL_RECORD_RETENTION_DAYS days
-        processed_calls[phone_number] = [
-            call_record for call_record in processed_calls[phone_number]
-            if call_record.get('timestamp', 0) > cutoff_time
-        ]
-
-        # Also limit the number of calls per phone number
-        if len(processed_calls[phone_number]) > MAX_CALLS_PER_NUMBER:
-            # Sort by timestamp (newest first) and keep only the most recent MAX_CALLS_PER_NUMBER calls
-            processed_calls[phone_number] = sorted(
-                processed_calls[phone_number], 
-                key=lambda x: x.get('timestamp', 0), 
-                reverse=True
-            )[:MAX_CALLS_PER_NUMBER]
-
-    # Save the cleaned up calls
-    save_processed_calls(processed_calls)
-    logging.info(f"Cleaned up processed calls cache. Current size: {sum(len(calls) for calls in processed_calls.values())} call records")
-
-# Load initially
-processed_calls = load_processed_calls()
-
-# Clean up old calls on startup
-cleanup_old_calls()
-
-# Create a session with retry capabilities
-def create_requests_session(retries=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504, 429)):
-    session = requests.Session()
-    retry = Retry(total=retries, read=retries, connect=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist)
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-# Load environment variables
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
-
-# Twilio / HubSpot Credentials
-TWILIO_SID = os.getenv("TWILIO_SID")
-TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_PHONE = os.getenv("TWILIO_PHONE")
-TECHNICIAN_NUMBERS = os.getenv("TECHNICIAN_NUMBERS", "")
-HUBSPOT_API_KEY = os.getenv("HUBSPOT_API_KEY")
-
-app = Flask(__name__)
-
-@app.errorhandler(Exception)
+
+def load_config():
+    """Read the connector's settings from the environment (and .env). Nothing is opened or started."""
+    load_dotenv()
+    batch_size = os.getenv("HUBSPOT_BATCH_SIZE", "50")
+    return {
+        # Twilio / HubSpot Credentials
+        'TWILIO_SID': os.getenv("TWILIO_SID"),
+        'TWILIO_AUTH_TOKEN': os.getenv("TWILIO_AUTH_TOKEN"),
+        'TWILIO_PHONE': os.getenv("TWILIO_PHONE"),
+        'HUBSPOT_API_KEY': os.getenv("HUBSPOT_API_KEY"),
+
+        # Optional JSON file with technician routing; edits are picked up without restarting workers
+        'ROUTING_FILE': os.getenv("ROUTING_FILE", ""),
+
+        # Background delivery of call events to HubSpot
+        'CALL_QUEUE_DIR': os.getenv("CALL_QUEUE_DIR", "call_queue"),
+        # Each worker waits on the batcher with one call, so a batch fills up only with at least as many workers
+        'CALL_QUEUE_WORKERS': int(os.getenv("CALL_QUEUE_WORKERS", batch_size)),
+        'CALL_QUEUE_MAX_ATTEMPTS': int(os.getenv("CALL_QUEUE_MAX_ATTEMPTS", "8")),
+
+        # Processed calls, shared by all worker processes (":memory:" for a throwaway per-process store)
+        'DEDUPE_DB': os.getenv("DEDUPE_DB", "processed_calls.db"),
+        'DEDUPE_SWEEP_INTERVAL': int(os.getenv("DEDUPE_SWEEP_INTERVAL", "300")),
+
+        # How long to wait for the rest of a call's legs before logging it. Without a dial result or an
+        # answered leg, the wait has to outlast the longest call: ringing plus the dial's time limit
+        'CORRELATION_WINDOW': float(os.getenv("CORRELATION_WINDOW",
+                                              str(DIAL_TIMEOUT + DIAL_TIME_LIMIT + CALLBACK_GRACE_SECONDS))),
+        'CORRELATION_SETTLE': float(os.getenv("CORRELATION_SETTLE", "5")),
+
+        # Phone number -> HubSpot contact ID cache; the SQLite file lets gunicorn workers share hits (empty disables it)
+        'CONTACT_CACHE_DB': os.getenv("CONTACT_CACHE_DB", "contact_cache.db"),
+        'CONTACT_CACHE_SIZE': int(os.getenv("CONTACT_CACHE_SIZE", "10000")),
+        'CONTACT_CACHE_TTL': int(os.getenv("CONTACT_CACHE_TTL", "3600")),
+        'CONTACT_CACHE_NEGATIVE_TTL': int(os.getenv("CONTACT_CACHE_NEGATIVE_TTL", "60")),
+
+        # HubSpot API client: endpoint, per-request timeout and keep-alive connections per process
+        'HUBSPOT_BASE_URL': os.getenv("HUBSPOT_BASE_URL", HUBSPOT_BASE_URL),
+        'HUBSPOT_TIMEOUT': float(os.getenv("HUBSPOT_TIMEOUT", "10")),
+        'HUBSPOT_POOL_SIZE': int(os.getenv("HUBSPOT_POOL_SIZE", "10")),
+        # Requests per second for the whole app; the SQLite file shares the limit between processes (empty: per process)
+        'HUBSPOT_RATE_PER_SECOND': float(os.getenv("HUBSPOT_RATE_PER_SECOND", str(DEFAULT_RATE_PER_SECOND))),
+        'HUBSPOT_RATE_LIMIT_DB': os.getenv("HUBSPOT_RATE_LIMIT_DB", "hubspot_rate_limit.db"),
+
+        # Micro-batching of HubSpot writes: flush after this many calls or this long after the first one
+        'HUBSPOT_BATCH_SIZE': int(batch_size),
+        'HUBSPOT_BATCH_WAIT_MS': int(os.getenv("HUBSPOT_BATCH_WAIT_MS", "500")),
+
+        # Logs are written by a background thread; "json" gives one structured object per line, "text" the classic format
+        'LOG_LEVEL': os.getenv("LOG_LEVEL", "INFO"),
+        'LOG_FORMAT': os.getenv("LOG_FORMAT", "json"),
+        # Fraction of webhook requests whose full form payload is logged (all of them at DEBUG)
+        'LOG_PAYLOAD_SAMPLE_RATE': float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01")),
+
+        # Directory where each worker publishes its metrics so /metrics reports all of them (empty: this process only)
+        'METRICS_DIR': os.getenv("METRICS_DIR", "metrics_snapshots"),
+    }
+
+
+def configure_logging(config):
+    structured_logging.configure(config['LOG_LEVEL'], config['LOG_FORMAT'])
+
+
+def prepare_state(config):
+    """One-time startup work: create the schemas, import the legacy JSON history, expire old records,
+    checkpoint the database and clear the previous run's metric snapshots.
+
+    Meant to run once per deployment, from gunicorn's on_starting hook in the master (see
+    gunicorn.conf.py), so workers only open an already compact SQLite file. Everything here is
+    also safe to skip: workers import a leftover JSON file themselves and sweep on their own.
+    """
+    # Counters start again from zero with the new set of workers
+    metrics.remove_snapshots(config['METRICS_DIR'])
+    if config['DEDUPE_DB'] == ":memory:":
+        # Nothing is shared between processes, so there is nothing to prepare
+        return
+    store = create_dedupe_store(config['DEDUPE_DB'], MAX_CALLS_PER_NUMBER)
+    correlator = CallCorrelator(config['DEDUPE_DB'], emit=None, update=None)
+    try:
+        store.migrate_json(PROCESSED_CALLS_FILE)
+        # Holding the sweep lease means the workers' first sweep is skipped instead of repeated
+        if store.acquire_sweep_lease(config['DEDUPE_SWEEP_INTERVAL'] * 0.9):
+            ExpirySweeper(store, CALL_RECORD_RETENTION_DAYS, also_expire=[correlator]).sweep()
+        store.compact()
+        if config['CONTACT_CACHE_DB']:
+            SqliteContactStore(config['CONTACT_CACHE_DB']).close()
+        if config['HUBSPOT_RATE_LIMIT_DB']:
+            SharedTokenBucket(config['HUBSPOT_RATE_LIMIT_DB'], "default", config['HUBSPOT_RATE_PER_SECOND'],
+                              DEFAULT_BURST).close()
+    finally:
+        # SQLite connections must not be carried across the fork into the workers
+        correlator.close()
+        store.close()
+
+
+class Connector:
+    """The connector's per-process services, each built on first use.
+
+    Importing the module and calling create_app() open no files and start no threads, so a
+    gunicorn worker boots in constant time however much call history there is. Services are
+    rebuilt in a forked child instead of sharing its parent's SQLite connections and threads.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._services = {}
+        self._pid = None
+        self._started_pid = None
+        self._lock = threading.RLock()
+
+    def _service(self, name, build):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._services = {}
+                    self._pid = os.getpid()
+        service = self._services.get(name)
+        if service is None:
+            with self._lock:
+                service = self._services.get(name)
+                if service is None:
+                    service = self._services[name] = build()
+        return service
+
+    @property
+    def dedupe_store(self):
+        def build():
+            store = create_dedupe_store(self.config['DEDUPE_DB'], MAX_CALLS_PER_NUMBER)
+            # Normally already done by prepare_state(); only a file check when it was
+            store.migrate_json(PROCESSED_CALLS_FILE)
+            return store
+        return self._service('dedupe_store', build)
+
+    @property
+    def routing(self):
+        def build():
+            # Validate technician routing and pre-render the TwiML for every variant
+            routing = RoutingCache(self.config['ROUTING_FILE'])
+            routing.reload()
+            return routing
+        return self._service('routing', build)
+
+    @property
+    def contact_cache(self):
+        return self._service('contact_cache', lambda: ContactCache(
+            max_size=self.config['CONTACT_CACHE_SIZE'],
+            ttl=self.config['CONTACT_CACHE_TTL'],
+            negative_ttl=self.config['CONTACT_CACHE_NEGATIVE_TTL'],
+            store=SqliteContactStore(self.config['CONTACT_CACHE_DB']) if self.config['CONTACT_CACHE_DB'] else None
+        ))
+
+    @property
+    def hubspot_client(self):
+        # One pooled session per process; a forked worker builds its own instead of sharing sockets
+        return self._service('hubspot_client', lambda: HubSpotClient(
+            self.config['HUBSPOT_API_KEY'],
+            base_url=self.config['HUBSPOT_BASE_URL'],
+            timeout=self.config['HUBSPOT_TIMEOUT'],
+            pool_size=self.config['HUBSPOT_POOL_SIZE'],
+            rate_per_second=self.config['HUBSPOT_RATE_PER_SECOND'],
+            rate_limit_db=self.config['HUBSPOT_RATE_LIMIT_DB'] or None
+        ))
+
+    @property
+    def call_batcher(self):
+        return self._service('call_batcher', lambda: CallBatcher(
+            self.hubspot_client,
+            self.contact_cache,
+            max_batch_size=self.config['HUBSPOT_BATCH_SIZE'],
+            max_wait=self.config['HUBSPOT_BATCH_WAIT_MS'] / 1000
+        ))
+
+    @property
+    def call_queue(self):
+        # Webhooks only journal the event; background workers make the HubSpot round-trips
+        return self._service('call_queue', lambda: CallEventQueue(
+            self.deliver_call_event,
+            journal_dir=self.config['CALL_QUEUE_DIR'],
+            workers=self.config['CALL_QUEUE_WORKERS'],
+            max_attempts=self.config['CALL_QUEUE_MAX_ATTEMPTS'],
+            on_dead_letter=self.dead_letter_call_event
+        ))
+
+    @property
+    def correlator(self):
+        # Parent and technician legs of a call are merged into one engagement
+        return self._service('correlator', lambda: CallCorrelator(
+            self.config['DEDUPE_DB'],
+            self.emit_correlated_call,
+            self.update_correlated_call,
+            window=self.config['CORRELATION_WINDOW'],
+            settle=self.config['CORRELATION_SETTLE']
+        ))
+
+    @property
+    def expiry_sweeper(self):
+        # The per-number cap is enforced as calls are claimed; retention runs off the request path
+        return self._service('expiry_sweeper', lambda: ExpirySweeper(
+            self.dedupe_store,
+            CALL_RECORD_RETENTION_DAYS,
+            interval=self.config['DEDUPE_SWEEP_INTERVAL'],
+            also_expire=[self.correlator]
+        ))
+
+    def start(self):
+        """Start this process's background threads. Only the first call in each process does any work."""
+        if self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self.routing.install_reload_signal()
+            self.correlator.start()
+            # Start the workers now so events journaled before a restart are delivered without waiting for the next call
+            self.call_queue.start()
+            self.expiry_sweeper.start()
+            metrics.REGISTRY.add_collector(self.collect_metrics)
+            metrics.REGISTRY.start()
+            self._started_pid = os.getpid()
+
+    def collect_metrics(self):
+        """Copy the numbers this process's services keep themselves into the metrics registry."""
+        # Only services that already exist; a scrape shouldn't build the queue or open databases
+        services = self._services if self._pid == os.getpid() else {}
+        call_queue = services.get('call_queue')
+        metrics.CALL_QUEUE_DEPTH.set(call_queue.depth() if call_queue else 0)
+        contact_cache = services.get('contact_cache')
+        if contact_cache:
+            stats = contact_cache.stats()
+            for result, key in (("hit", 'hits'), ("negative_hit", 'negative_hits'), ("miss", 'misses'),
+                                ("store_hit", 'store_hits')):
+                metrics.CONTACT_CACHE_LOOKUPS.set(stats[key], result=result)
+        expiry_sweeper = services.get('expiry_sweeper')
+        if expiry_sweeper:
+            stats = expiry_sweeper.stats()
+            metrics.DEDUPE_SWEEPS.set(stats['sweeps'])
+            metrics.DEDUPE_EVICTED.set(stats['evicted_total'])
+            metrics.DEDUPE_SWEEP_SECONDS.set(stats['total_duration_seconds'])
+
+    def deliver_call_event(self, event):
+        if event.get('kind') == 'update':
+            return self.update_call_in_hubspot(event)
+        call_id = self.log_call_to_hubspot(
+            event['caller_id'],
+            event['call_duration'],
+            event['call_timestamp'],
+            event['disposition'],
+            event['status'],
+            event['call_sid']
+        )
+        if call_id and event.get('call_sid'):
+            self.correlator.set_engagement(event['call_sid'], call_id)
+        return bool(call_id)
+
+    def dead_letter_call_event(self, event):
+        # A call whose create was given up on has no engagement for late data to update
+        if event.get('kind') != 'update' and event.get('call_sid'):
+            self.correlator.skip(event['call_sid'])
+
+    def emit_correlated_call(self, call):
+        disposition, status, duration = call.classify()
+        # Calls logged before correlation existed, or by a backfill, are already claimed
+        with metrics.STORE_WRITE_SECONDS.time(store="dedupe"):
+            claimed = self.dedupe_store.claim(call.phone, call.root_sid, call.sids, call.first_seen)
+        metrics.DEDUPE_CLAIMS.inc(result="claimed" if claimed else "duplicate")
+        if not claimed and call.recovered and not self.correlator.engagement_id(call.root_sid):
+            # Most likely our own claim from an attempt that died before the call was marked emitted, in which
+            # case it may never have been queued. Queue it again: a duplicate beats a lost call
+            logging.info(f"Call {call.root_sid} was claimed by an interrupted emit, queueing it again")
+            self.enqueue_call(call.phone, duration, call.first_seen, disposition, status, call.root_sid)
+            return
+        if not claimed:
+            logging.info(f"Call {call.root_sid} already processed, skipping")
+            # Its engagement isn't ours to update, so late legs shouldn't queue updates for it
+            self.correlator.skip(call.root_sid)
+            return
+        try:
+            self.enqueue_call(call.phone, duration, call.first_seen, disposition, status, call.root_sid)
+        except Exception:
+            self.dedupe_store.release(call.root_sid)
+            raise
+        logging.info(f"Queued call {call.root_sid} from {call.phone} for HubSpot with duration: {duration}s, disposition: {disposition}")
+
+    def update_correlated_call(self, call):
+        disposition, status, duration = call.classify()
+        self.call_queue.enqueue({
+            'kind': 'update',
+            'caller_id': call.phone,
+            'call_duration': duration,
+            'call_timestamp': call.first_seen,
+            'disposition': disposition,
+            'status': status,
+            'call_sid': call.root_sid
+        })
+
+    def enqueue_call(self, caller_id, call_duration=0, call_timestamp=None, disposition="CONNECTED", status="COMPLETED", call_sid=None):
+        return self.call_queue.enqueue({
+            'caller_id': caller_id,
+            'call_duration': call_duration,
+            'call_timestamp': call_timestamp or int(time.time() * 1000),
+            'disposition': disposition,
+            'status': status,
+            'call_sid': call_sid
+        })
+
+    def log_call_to_hubspot(self, caller_id, call_duration=0, call_timestamp=None, disposition="CONNECTED", status="COMPLETED", call_sid=None):
+        """Create the call engagement in HubSpot. Returns its ID, or False if it could not be logged."""
+        if not self.config['HUBSPOT_API_KEY']:
+            logging.error("HubSpot API key not configured. Cannot log call.")
+            return False
+
+        properties = call_properties(caller_id, call_duration, call_timestamp or int(time.time() * 1000), disposition, status)
+
+        try:
+            # Concurrent calls are resolved and written together through HubSpot's batch APIs
+            return self.call_batcher.log_call(caller_id, properties) or False
+        except Exception as e:
+            logging.error(f"Error in log_call_to_hubspot: {str(e)}")
+            return False
+
+    def update_call_in_hubspot(self, event):
+        if not self.config['HUBSPOT_API_KEY']:
+            logging.error("HubSpot API key not configured. Cannot update call.")
+            return False
+
+        engagement_id = self.correlator.engagement_id(event['call_sid'])
+        if not engagement_id and self.correlator.is_skipped(event['call_sid']):
+            logging.info(f"Call {event['call_sid']} was not logged by this service, dropping its update")
+            return True
+        if not engagement_id:
+            # The original engagement hasn't been written yet; the queue will retry
+            logging.info(f"No engagement yet for call {event['call_sid']}, retrying update later")
+            return False
+
+        properties = call_properties(event['caller_id'], event['call_duration'], event['call_timestamp'],
+                                     event['disposition'], event['status'])
+        try:
+            self.hubspot_client.update_call(engagement_id, properties)
+            logging.info(f"Updated call {engagement_id} in HubSpot with duration: {event['call_duration']}s, disposition: {event['disposition']}")
+            return True
+        except Exception as e:
+            logging.error(f"Error in update_call_in_hubspot: {str(e)}")
+            return False
+
+
+def call_properties(caller_id, call_duration, call_timestamp, disposition, status):
+    return {
+        "hs_call_body": f"Incoming call from {caller_id}",
+        "hs_call_direction": "INBOUND",
+        "hs_call_disposition": disposition,
+        "hs_call_duration": str(int(call_duration) * 1000),
+        "hs_call_from_number": caller_id,
+        "hs_call_status": status,
+        "hs_timestamp": str(call_timestamp)
+    }
+
+
+bp = Blueprint('connector', __name__)
+
+
+def get_connector():
+    return current_app.extensions['connector']
+
+
+def log_request_payload(message):
+    # The full form is large and holds caller details; only a sample of requests log it
+    structured_logging.log_payload(message, request.form, current_app.config['LOG_PAYLOAD_SAMPLE_RATE'])
+
+
+@bp.before_app_request
+def start_background_work():
+    g.request_started = time.perf_counter()
+    # Background threads belong to the process serving requests, not to whoever imported the app
+    get_connector().start()
+
+@bp.after_app_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    started = g.get('request_started')
+    if started is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=request.method)
+    metrics.HTTP_REQUESTS.inc(route=route, status=response.status_code)
+    return response
+
+@bp.app_errorhandler(Exception)
 def handle_exception(e):
     logging.error(f"Unhandled Exception: {e}", exc_info=True)
     return Response("An internal error occurred.", status=500)
 
-@app.route("/", methods=['GET', 'POST'])
+@bp.route("/", methods=['GET', 'POST'])
 def debug():
-    logging.info(f"Root endpoint accessed: {request.form}")
+    log_request_payload("Root endpoint accessed")
     return Response("Use /voice for Twilio.", status=200)
 
-@app.route("/voice", methods=['POST'])
+@bp.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    # Totals across every worker publishing to METRICS_DIR, whichever one serves the scrape
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@bp.route("/voice", methods=['POST'])
 def voice():
-    logging.info(f"Voice endpoint request: {request.form}")
+    log_request_payload("Voice endpoint request")
     from_number = request.form.get('From')
     call_sid = request.form.get('CallSid')
     logging.info(f"Incoming call from {from_number}")
@@ -129,68 +440,48 @@ def voice():
         # This is what allows the status endpoints to log to HubSpot
         pass
 
-    resp = VoiceResponse()
-    tech_numbers = [num.strip() for num in TECHNICIAN_NUMBERS.split(",") if num.strip()]
-    if not tech_numbers or not all(re.match(r'^\+\d{10,15}$', num) for num in tech_numbers):
+    table = get_connector().routing.current()
+    if table is None:
         logging.error("Invalid or empty technician numbers")
         return Response("Invalid technician numbers", status=500)
 
-    dial = Dial(
-        timeout=30,
-        timeLimit=600,
-        action="/call-status",
-        method="POST"
-    )
-    for tn in tech_numbers:
-        dial.number(
-            tn,
-            status_callback_event="completed",
-            status_callback="/call-completed",
-            status_callback_method="POST"
-        )
-    resp.append(dial)
-
-    return Response(str(resp), mimetype='text/xml')
+    return Response(table.initial(), mimetype='text/xml')
 
-@app.route("/call-status", methods=['POST'])
+@bp.route("/call-status", methods=['POST'])
 def call_status():
-    logging.info(f"Call-status endpoint request: {request.form}")
+    log_request_payload("Call-status endpoint request")
     call_sid = request.form.get('CallSid')
     call_status = request.form.get('DialCallStatus')
     dial_call_sid = request.form.get('DialCallSid')
     from_number = request.form.get('From')
 
     logging.info(f"Call status update for {call_sid} from {from_number}: {call_status}")
+
+    # With sequential ring an unanswered technician hands the call on to the next one
+    next_step = next_routing_step(call_status)
+    if next_step:
+        return Response(next_step, mimetype='text/xml')
+
     if from_number and call_status and call_sid:
-        # Check if this call has already been processed
-        global processed_calls
-        if (from_number in processed_calls and 
-            (any(record.get('call_sid') == call_sid for record in processed_calls[from_number]) or 
-             (dial_call_sid and any(record.get('call_sid') == dial_call_sid for record in processed_calls[from_number])))):
-            logging.info(f"Call {call_sid} or related call {dial_call_sid} already processed, skipping")
-        else:
-            try:
-                disposition = "CONNECTED" if call_status.lower() not in ["no-answer", "busy", "failed", "canceled"] else "NO_ANSWER"
-                status = "COMPLETED" if disposition == "CONNECTED" else "MISSED"
-                current_timestamp = int(time.time() * 1000)
-                log_call_to_hubspot(from_number, 0, current_timestamp, disposition, status, call_sid)
-
-                # Mark call as processed with timestamp
-                call_record = {'call_sid': call_sid, 'timestamp': current_timestamp}
-                processed_calls[from_number] = processed_calls.get(from_number, []) + [call_record]
-                save_processed_calls(processed_calls)
-
-                if disposition == "NO_ANSWER":
-                    logging.info(f"Logged missed call from {from_number} with status: {call_status}")
-            except Exception as e:
-                logging.error(f"Error logging missed call to HubSpot: {str(e)}")
+        try:
+            dial_duration = request.form.get('DialCallDuration', '0')
+            with metrics.STORE_WRITE_SECONDS.time(store="correlator"):
+                get_connector().correlator.record_dial(
+                    call_sid,
+                    from_number,
+                    call_status,
+                    dial_call_sid,
+                    int(dial_duration) if dial_duration.isdigit() else 0
+                )
+        except Exception as e:
+            logging.error(f"Error recording call status: {str(e)}")
 
     resp = VoiceResponse()
     return Response(str(resp), mimetype='text/xml')
 
-@app.route("/call-completed", methods=['POST'])
+@bp.route("/call-completed", methods=['POST'])
 def call_completed():
-    logging.info(f"Call-completed endpoint request: {request.form}")
+    log_request_payload("Call-completed endpoint request")
     call_sid = request.form.get('CallSid')
     parent_call_sid = request.form.get('ParentCallSid')
     from_number = request.form.get('From')
@@ -198,112 +489,62 @@ def call_completed():
     call_status = request.form.get('CallStatus')
 
     logging.info(f"Call completed: {call_sid} from {from_number}, duration: {call_duration}s, status: {call_status}")
+
+    # An unanswered leg that isn't the last sequential-ring step is not the end of the call
+    if call_status and call_status.lower() != "completed" and not is_final_routing_step():
+        logging.info(f"Call {call_sid} not answered, ringing next technician")
+        return Response("OK", status=200)
+
     if from_number and call_sid:
-        # Check if this call OR its parent has been processed
-        global processed_calls
-        if (from_number in processed_calls and 
-            (any(record.get('call_sid') == call_sid for record in processed_calls[from_number]) or 
-             (parent_call_sid and any(record.get('call_sid') == parent_call_sid for record in processed_calls[from_number])))):
-            logging.info(f"Call {call_sid} or parent {parent_call_sid} already processed, skipping")
-        else:
-            try:
-                duration_seconds = int(call_duration) if call_duration.isdigit() else 0
-                # Log exactly what Twilio is sending to help diagnose
-                logging.info(f"Raw call data: duration={duration_seconds}s, status={call_status}")
-
-                # More restrictive connected call definition
-                disposition = "CONNECTED" if (duration_seconds > 15 and 
-                                call_status.lower() == "completed") else "NO_ANSWER"
-                status = "COMPLETED" if disposition == "CONNECTED" else "MISSED"
-                current_timestamp = int(time.time() * 1000)
-                log_call_to_hubspot(from_number, duration_seconds, current_timestamp, disposition, status, call_sid)
-                logging.info(f"Updated call in HubSpot with duration: {duration_seconds}s, disposition: {disposition}")
-
-                # Mark call as processed with timestamp
-                call_record = {'call_sid': call_sid, 'timestamp': current_timestamp}
-                processed_calls[from_number] = processed_calls.get(from_number, []) + [call_record]
-                save_processed_calls(processed_calls)
-
-                # Periodically clean up old calls (every 10 calls)
-                if sum(len(calls) for calls in processed_calls.values()) % 10 == 0:
-                    cleanup_old_calls()
-            except Exception as e:
-                logging.error(f"Error updating call in HubSpot: {str(e)}")
+        try:
+            duration_seconds = int(call_duration) if call_duration.isdigit() else 0
+            # Log exactly what Twilio is sending to help diagnose
+            logging.info(f"Raw call data: duration={duration_seconds}s, status={call_status}")
+            with metrics.STORE_WRITE_SECONDS.time(store="correlator"):
+                get_connector().correlator.record_leg(parent_call_sid, call_sid, from_number, call_status or "", duration_seconds)
+        except Exception as e:
+            logging.error(f"Error recording completed call: {str(e)}")
 
     return Response("OK", status=200)
 
-def log_call_to_hubspot(caller_id, call_duration=0, call_timestamp=None, disposition="CONNECTED", status="COMPLETED", call_sid=None):
-    if not HUBSPOT_API_KEY:
-        logging.error("HubSpot API key not configured. Cannot log call.")
-        return False
+def routing_step_args():
+    step = request.args.get('step', '')
+    return request.args.get('route'), int(step) if step.isdigit() else None
 
-    call_duration_ms = int(call_duration) * 1000
-    headers = {'Authorization': f'Bearer {HUBSPOT_API_KEY}', 'Content-Type': 'application/json'}
-    session = create_requests_session(retries=3, backoff_factor=0.5)
-    timeout = 10
+def next_routing_step(dial_call_status):
+    route, step = routing_step_args()
+    if step is None or not dial_call_status or dial_call_status.lower() not in ["no-answer", "busy", "failed"]:
+        return None
+    table = get_connector().routing.current()
+    return table.step(route, step + 1) if table else None
+
+def is_final_routing_step():
+    route, step = routing_step_args()
+    table = get_connector().routing.current()
+    return step is None or table is None or table.is_last_step(route, step)
+
+
+def create_app(config=None):
+    """Build the Flask app. config overrides settings from the environment.
+
+    Cheap and free of side effects: the dedupe store, HubSpot client, routing and background
+    threads are set up lazily in whichever process serves the first request.
+    """
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(config or {})
+    configure_logging(app.config)
+    if app.config['METRICS_DIR']:
+        metrics.REGISTRY.share(app.config['METRICS_DIR'])
+    app.extensions['connector'] = Connector(app.config)
+    app.register_blueprint(bp)
+    return app
 
-    try:
-        search_url = "https://api.hubapi.com/crm/v3/objects/contacts/search"
-        search_payload = {
-            "filterGroups": [
-                {
-                    "filters": [
-                        {"propertyName": "phone", "operator": "EQ", "value": caller_id}
-                    ]
-                },
-                {
-                    "filters": [
-                        {"propertyName": "mobilephone", "operator": "EQ", "value": caller_id}
-                    ]
-                }
-            ]
-        }
-        response = session.post(search_url, json=search_payload, headers=headers, timeout=timeout)
-
-        contact_id = None
-        if response.status_code == 200:
-            search_results = response.json()
-            contact_id = search_results.get('results', [{}])[0].get('id') if search_results.get('results') else None
-            if not contact_id:
-                create_url = "https://api.hubapi.com/crm/v3/objects/contacts"
-                create_payload = {"properties": {"phone": caller_id, "firstname": "Unknown", "lastname": "Caller"}}
-                create_response = session.post(create_url, json=create_payload, headers=headers, timeout=timeout)
-                if create_response.status_code == 201:
-                    contact_id = create_response.json().get('id')
-                    logging.info(f"Created new contact: {contact_id}")
-                else:
-                    logging.error(f"Failed to create contact: {create_response.status_code} - {create_response.text}")
-        else:
-            logging.error(f"Contact search failed: {response.status_code} - {response.text}")
-
-        if contact_id:
-            call_timestamp = call_timestamp or int(time.time() * 1000)
-            call_url = "https://api.hubapi.com/crm/v3/objects/calls"
-            call_payload = {
-                "properties": {
-                    "hs_call_body": f"Incoming call from {caller_id}",
-                    "hs_call_direction": "INBOUND",
-                    "hs_call_disposition": disposition,
-                    "hs_call_duration": str(call_duration_ms),
-                    "hs_call_from_number": caller_id,
-                    "hs_call_status": status,
-                    "hs_timestamp": str(call_timestamp)
-                },
-                "associations": [{"to": {"id": contact_id}, "types": [{"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": 194}]}]
-            }
-            call_response = session.post(call_url, json=call_payload, headers=headers, timeout=timeout)
-            if call_response.status_code == 201:
-                logging.info(f"Successfully logged call to HubSpot for contact {contact_id}")
-                return True
-            else:
-                logging.error(f"Failed to log call: {call_response.status_code} - {call_response.text}")
-        else:
-            logging.error("No contact ID available, cannot log call")
-            return False
 
-    except Exception as e:
-        logging.error(f"Error in log_call_to_hubspot: {str(e)}")
-        return False
+# For `gunicorn TwilioHubspotConnector:app`; nothing is opened or started until a request arrives
+app = create_app()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
+    prepare_state(app.config)
+    app.extensions['connector'].start()
+    app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,427 @@
+"""Log calls from an exported Twilio call log to HubSpot, skipping the ones already logged.
+
+Reads a CSV or JSONL export of Twilio call records (one row per call leg, as exported from the
+console or the Calls API) as a stream, groups each inbound call with its technician legs, applies
+the same disposition rules as the webhooks and writes the missing engagements through a bounded
+pool of workers. Progress is checkpointed, so an interrupted run picks up where it stopped.
+
+    python backfill_calls.py calls.csv --checkpoint backfill.checkpoint.json
+    python backfill_calls.py calls.jsonl --dry-run --report missing.jsonl
+"""
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from call_correlator import classify_call
+from TwilioHubspotConnector import Connector, load_config, configure_logging, CALL_RECORD_RETENTION_DAYS
+
+# Rows a call's legs may be spread over in the export before the call is processed without them
+DEFAULT_WINDOW = 1000
+
+# Attempts per call before its rows go to the failures file, with exponential backoff in between
+DEFAULT_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 2.0
+
+# Write the checkpoint at most this often
+CHECKPOINT_INTERVAL = 2.0
+
+# Twilio's CSV headers ("Parent Call Sid", "ParentCallSid") and API fields ("parent_call_sid")
+# all reduce to the same key
+FIELD_ALIASES = {
+    'sid': 'sid', 'callsid': 'sid',
+    'parentcallsid': 'parent_call_sid',
+    'from': 'from', 'to': 'to',
+    'status': 'status',
+    'duration': 'duration',
+    'starttime': 'start_time', 'datecreated': 'date_created',
+    'direction': 'direction'
+}
+
+
+def normalize(row):
+    record = {}
+    for key, value in row.items():
+        field = FIELD_ALIASES.get(str(key).lower().replace("_", "").replace(" ", ""))
+        if field and value not in (None, ""):
+            record[field] = str(value).strip()
+    return record
+
+
+def parse_timestamp(value):
+    """Twilio timestamps (RFC 2822 from the API, ISO 8601 from the console) as epoch milliseconds."""
+    if not value:
+        return None
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def read_records(path, fmt):
+    """Yield normalized records one at a time."""
+    f = sys.stdin if path == "-" else open(path, 'r', newline='', encoding='utf-8-sig')
+    try:
+        if fmt == "jsonl":
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield normalize(json.loads(line))
+        else:
+            for row in csv.DictReader(f):
+                yield normalize(row)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class BackfillCall:
+    """An inbound call and whichever of its technician legs were seen."""
+
+    def __init__(self, root_sid):
+        self.root_sid = root_sid
+        self.parent = None
+        self.legs = []
+
+    @property
+    def sids(self):
+        return [leg['sid'] for leg in self.legs]
+
+    @property
+    def rows(self):
+        return ([self.parent] if self.parent else []) + self.legs
+
+    @property
+    def phone(self):
+        return (self.parent or {}).get('from') or next((leg.get('from') for leg in self.legs if leg.get('from')), None)
+
+    @property
+    def timestamp(self):
+        for row in self.rows:
+            timestamp = parse_timestamp(row.get('start_time') or row.get('date_created'))
+            if timestamp:
+                return timestamp
+        return None
+
+    def classify(self):
+        """Returns (disposition, status, duration_seconds), using the webhooks' rules.
+
+        Technician legs play the part of /call-completed. Without any, nothing says a technician
+        answered: the parent call's status only tells that the TwiML ran, not how the <Dial> went.
+        Like a call whose dial result never reaches the webhooks, it is logged as not answered.
+        """
+        if self.legs:
+            completed = [leg for leg in self.legs if leg.get('status', '').lower() == "completed"]
+            leg_status = "completed" if completed else self.legs[-1].get('status', '')
+            leg_duration = max(_seconds(leg.get('duration')) for leg in (completed or self.legs))
+            return classify_call(leg_status=leg_status, leg_duration=leg_duration)
+        return classify_call()
+
+
+def _seconds(value):
+    return int(value) if value and str(value).isdigit() else 0
+
+
+def group_calls(records, window, stats):
+    """Group leg records under their parent call with at most window calls held in memory.
+
+    Calls are yielded oldest first as they leave the window, so the same input always yields
+    the same calls in the same order; checkpoints count calls in that order.
+    """
+    pending = OrderedDict()
+    # Legs turning up after their call was already yielded are dropped, not logged as a new call
+    done = set()
+    done_order = deque()
+
+    def finish(call):
+        done.add(call.root_sid)
+        done_order.append(call.root_sid)
+        if len(done_order) > window * 10:
+            done.discard(done_order.popleft())
+        return call
+
+    for record in records:
+        stats['rows'] += 1
+        sid = record.get('sid')
+        direction = (record.get('direction') or "").lower()
+        if not sid:
+            stats['rows_invalid'] += 1
+            continue
+        if record.get('parent_call_sid'):
+            root_sid, is_leg = record['parent_call_sid'], True
+        elif direction.startswith("inbound") or not direction:
+            root_sid, is_leg = sid, False
+        else:
+            # Outbound calls the connector didn't forward
+            stats['rows_not_inbound'] += 1
+            continue
+        if root_sid in done:
+            stats['late_legs'] += 1
+            continue
+
+        call = pending.get(root_sid)
+        if call is None:
+            call = pending[root_sid] = BackfillCall(root_sid)
+        if is_leg:
+            call.legs.append(record)
+        else:
+            call.parent = record
+
+        while len(pending) > window:
+            yield finish(pending.popitem(last=False)[1])
+    while pending:
+        yield finish(pending.popitem(last=False)[1])
+
+
+class Checkpoint:
+    """Records how many calls, in input order, are done, so a rerun can skip them.
+
+    Calls finish out of order in the worker pool; only the contiguous prefix counts. Calls
+    claimed in the dedupe store but not yet written are recorded too, and the checkpoint is
+    written as soon as that set changes: after a hard kill, load() reports them in interrupted
+    so the rerun can release their claims instead of skipping them as already logged.
+    """
+
+    def __init__(self, path, source, window):
+        self.path = path
+        self.source = source
+        self.window = window
+        self.calls_done = 0
+        self.interrupted = []
+        self._in_flight = set()
+        self._finished = set()
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'r') as f:
+            state = json.load(f)
+        if state.get('source') != os.path.abspath(self.source) or state.get('window') != self.window:
+            raise SystemExit(f"Checkpoint {self.path} is for {state.get('source')} (window {state.get('window')}); "
+                             f"use --restart to start over")
+        self.calls_done = state.get('calls_done', 0)
+        self.interrupted = state.get('in_flight', [])
+        return self.calls_done
+
+    def claimed(self, call_sid, stats):
+        with self._lock:
+            self._in_flight.add(call_sid)
+            self._write(stats)
+
+    def finished(self, index, stats, call_sid=None):
+        with self._lock:
+            self._finished.add(index)
+            while self.calls_done in self._finished:
+                self._finished.remove(self.calls_done)
+                self.calls_done += 1
+            if call_sid in self._in_flight:
+                self._in_flight.remove(call_sid)
+                self._write(stats)
+            elif time.monotonic() - self._last_write >= CHECKPOINT_INTERVAL:
+                self._write(stats)
+
+    def save(self, stats):
+        with self._lock:
+            self._write(stats)
+
+    def _write(self, stats):
+        if not self.path:
+            return
+        state = {
+            'source': os.path.abspath(self.source),
+            'window': self.window,
+            'calls_done': self.calls_done,
+            'in_flight': sorted(self._in_flight),
+            'stats': dict(stats),
+            'updated_at': datetime.now(timezone.utc).isoformat(timespec='seconds')
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self._last_write = time.monotonic()
+
+
+class Backfill:
+    def __init__(self, connector, dry_run=False, include_old=False, report=None, failures=None, attempts=DEFAULT_ATTEMPTS):
+        self.connector = connector
+        self.attempts = attempts
+        self.dry_run = dry_run
+        self.include_old = include_old
+        self.report = report
+        self.failures = failures
+        self.stats = {key: 0 for key in (
+            'rows', 'rows_invalid', 'rows_not_inbound', 'late_legs', 'calls', 'resumed', 'already_logged',
+            'missing', 'logged', 'failed', 'too_old', 'no_phone', 'no_timestamp')}
+        self.checkpoint = None
+        self._lock = threading.Lock()
+        self._cutoff = int(time.time() * 1000) - CALL_RECORD_RETENTION_DAYS * 24 * 60 * 60 * 1000
+
+    def count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _write_line(self, f, entry):
+        if f is not None:
+            with self._lock:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+
+    def process(self, call):
+        """Log one call unless it already is. Returns the outcome, also counted in stats."""
+        outcome = self._process(call)
+        self.count(outcome)
+        return outcome
+
+    def _process(self, call):
+        phone, timestamp = call.phone, call.timestamp
+        if not phone:
+            return 'no_phone'
+        if timestamp is None:
+            return 'no_timestamp'
+        if timestamp < self._cutoff and not self.include_old:
+            # The dedupe store only remembers calls for the retention period, so an older call
+            # may well be logged already without us being able to tell
+            return 'too_old'
+
+        store = self.connector.dedupe_store
+        if store.is_processed(call.root_sid, *call.sids):
+            return 'already_logged'
+
+        disposition, status, duration = call.classify()
+        if self.dry_run:
+            self._write_line(self.report, {
+                'call_sid': call.root_sid, 'from': phone, 'timestamp': timestamp,
+                'disposition': disposition, 'status': status, 'duration': duration
+            })
+            return 'missing'
+
+        # Claimed first so the live service (or another backfill) won't log it as well
+        if not store.claim(phone, call.root_sid, call.sids, timestamp):
+            return 'already_logged'
+        if self.checkpoint:
+            self.checkpoint.claimed(call.root_sid, self.stats)
+        for attempt in range(self.attempts):
+            if attempt:
+                time.sleep(RETRY_BACKOFF_SECONDS ** attempt)
+            call_id = self.connector.log_call_to_hubspot(phone, duration, timestamp, disposition, status, call.root_sid)
+            if call_id:
+                break
+        if not call_id:
+            store.release(call.root_sid)
+            # The original rows, so the file can be fed back in as JSONL input
+            for row in call.rows:
+                self._write_line(self.failures, row)
+            return 'failed'
+        return 'logged'
+
+    def run(self, calls, checkpoint, workers):
+        skip = checkpoint.load()
+        if skip:
+            logging.info(f"Resuming after {skip} calls from checkpoint {checkpoint.path}")
+        if checkpoint.interrupted:
+            # Claimed by a run that was killed before it wrote them. A call that did reach HubSpot
+            # is logged a second time, but one that didn't would otherwise never be logged
+            logging.warning(f"Releasing {len(checkpoint.interrupted)} calls left in flight by the previous run")
+            for call_sid in checkpoint.interrupted:
+                self.connector.dedupe_store.release(call_sid)
+            checkpoint.interrupted = []
+        self.checkpoint = checkpoint
+
+        # At most this many calls are queued or in flight, which keeps memory flat
+        slots = threading.BoundedSemaphore(workers * 2)
+        started = time.monotonic()
+
+        def work(index, call):
+            try:
+                self.process(call)
+            except Exception as e:
+                logging.error(f"Backfill of call {call.root_sid} failed: {e}")
+                self.count('failed')
+            finally:
+                checkpoint.finished(index, self.stats, call.root_sid)
+                slots.release()
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+            try:
+                for index, call in enumerate(calls):
+                    self.count('calls')
+                    if index < skip:
+                        self.count('resumed')
+                        continue
+                    slots.acquire()
+                    pool.submit(work, index, call)
+                    if index and index % 10000 == 0:
+                        logging.info(f"Backfill progress: {index} calls read in {time.monotonic() - started:.0f}s, "
+                                     f"{self.stats['logged']} logged, {self.stats['missing']} missing, "
+                                     f"{self.stats['already_logged']} already logged")
+            except KeyboardInterrupt:
+                logging.warning("Interrupted, finishing calls in flight before saving the checkpoint")
+        checkpoint.save(self.stats)
+        return self.stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source", help="Twilio call log export (CSV or JSONL), or - for stdin")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="default: from the file extension")
+    parser.add_argument("--dry-run", action="store_true", help="only report calls missing from HubSpot")
+    parser.add_argument("--report", help="where --dry-run writes the missing calls as JSONL (default: stdout)")
+    parser.add_argument("--checkpoint", help="progress file for resuming (default: <source>.checkpoint.json)")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--failures", help="JSONL file for the rows of calls HubSpot rejected "
+                                           "(default: <source>.failed.jsonl)")
+    parser.add_argument("--workers", type=int, help="calls written concurrently (default: HUBSPOT_BATCH_SIZE)")
+    parser.add_argument("--attempts", type=int, default=DEFAULT_ATTEMPTS, help="tries per call before giving up")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                        help="rows a call's legs may be spread over in the export")
+    parser.add_argument("--include-old", action="store_true",
+                        help=f"also log calls older than the {CALL_RECORD_RETENTION_DAYS}-day dedupe retention")
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    configure_logging(config)
+    fmt = args.format or ("jsonl" if args.source.endswith((".jsonl", ".json", ".ndjson")) else "csv")
+    base = "backfill" if args.source == "-" else args.source
+    checkpoint_path = args.checkpoint or f"{base}{'.dry-run' if args.dry_run else ''}.checkpoint.json"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if not args.dry_run and not config['HUBSPOT_API_KEY']:
+        parser.error("HUBSPOT_API_KEY is not configured")
+
+    report = open(args.report, 'a') if args.report else sys.stdout
+    failures = None if args.dry_run else open(args.failures or f"{base}.failed.jsonl", 'a')
+    try:
+        backfill = Backfill(Connector(config), dry_run=args.dry_run, include_old=args.include_old,
+                            report=report if args.dry_run else None, failures=failures, attempts=args.attempts)
+        calls = group_calls(read_records(args.source, fmt), args.window, backfill.stats)
+        # Enough concurrent calls to fill each batched HubSpot write
+        workers = args.workers or config['HUBSPOT_BATCH_SIZE']
+        stats = backfill.run(calls, Checkpoint(checkpoint_path, args.source, args.window), workers)
+    finally:
+        if report is not sys.stdout:
+            report.close()
+        if failures:
+            failures.close()
+    logging.info(f"Backfill {'dry run ' if args.dry_run else ''}finished: {json.dumps(stats)}")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""A local stand-in for the parts of the HubSpot CRM API the connector uses.
+
+Serves contacts search (EQ and IN filters), contact create (single and batch) and call create
+(single and batch) and call update, with configurable latency, 5xx error rate and 429 injection.
+GET /__stats returns request counts per endpoint; POST /__reset clears them and all data.
+
+    python benchmarks/fake_hubspot.py --port 8089 --latency-ms 80 --error-rate 0.01 --rate-limit-rate 0.02
+
+then point the connector at it with HUBSPOT_BASE_URL=http://127.0.0.1:8089.
+"""
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeHubSpot:
+    """In-memory contacts and calls plus the fault injection settings."""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.contacts = {}
+            self.calls = {}
+            self.requests = Counter()
+            self.responses = Counter()
+            self._ids = itertools.count(1000)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'responses': dict(self.responses),
+                'total_requests': sum(self.requests.values()),
+                'contacts': len(self.contacts),
+                'calls': len(self.calls)
+            }
+
+    def next_id(self):
+        return str(next(self._ids))
+
+    # Handlers return (status, body); the caller has already counted the request
+
+    def search_contacts(self, body):
+        phones = set()
+        for group in body.get('filterGroups', []):
+            for f in group.get('filters', []):
+                if f.get('propertyName') in ('phone', 'mobilephone'):
+                    phones.update(f.get('values') or [f.get('value')])
+        with self.lock:
+            results = [
+                {'id': self.contacts[phone], 'properties': {'phone': phone}}
+                for phone in sorted(phones) if phone in self.contacts
+            ]
+        return 200, {'total': len(results), 'results': results}
+
+    def _create_contact(self, properties):
+        phone = properties.get('phone')
+        with self.lock:
+            contact_id = self.contacts.get(phone) or self.next_id()
+            self.contacts[phone] = contact_id
+        return {'id': contact_id, 'properties': properties}
+
+    def create_contact(self, body):
+        return 201, self._create_contact(body.get('properties') or {})
+
+    def batch_create_contacts(self, body):
+        results = [self._create_contact(item.get('properties') or {}) for item in body.get('inputs', [])]
+        # HubSpot doesn't return batch results in input order
+        random.shuffle(results)
+        return 201, {'status': 'COMPLETE', 'results': results}
+
+    def _create_call(self, item):
+        with self.lock:
+            call_id = self.next_id()
+            self.calls[call_id] = item
+        result = {'id': call_id, 'properties': item.get('properties') or {}}
+        if item.get('objectWriteTraceId'):
+            result['objectWriteTraceId'] = item['objectWriteTraceId']
+        return result
+
+    def create_call(self, body):
+        return 201, self._create_call(body)
+
+    def batch_create_calls(self, body):
+        results = [self._create_call(item) for item in body.get('inputs', [])]
+        random.shuffle(results)
+        return 201, {'status': 'COMPLETE', 'results': results}
+
+    def update_call(self, call_id, body):
+        with self.lock:
+            if call_id not in self.calls:
+                return 404, {'message': f"Call {call_id} not found"}
+            self.calls[call_id].setdefault('properties', {}).update(body.get('properties') or {})
+        return 200, {'id': call_id}
+
+
+ROUTES = [
+    ('POST', '/crm/v3/objects/contacts/search', 'search_contacts'),
+    ('POST', '/crm/v3/objects/contacts/batch/create', 'batch_create_contacts'),
+    ('POST', '/crm/v3/objects/contacts', 'create_contact'),
+    ('POST', '/crm/v3/objects/calls/batch/create', 'batch_create_calls'),
+    ('POST', '/crm/v3/objects/calls', 'create_call'),
+]
+
+
+class FakeHubSpotHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    hubspot = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _dispatch(self, method):
+        hubspot = self.hubspot
+        path = self.path.split('?')[0].rstrip('/')
+        body = self._body() if method in ('POST', 'PATCH') else {}
+
+        if path == '/__stats':
+            return self._send(200, hubspot.stats())
+        if path == '/__reset':
+            hubspot.reset()
+            return self._send(200, {})
+
+        if method == 'PATCH' and path.startswith('/crm/v3/objects/calls/'):
+            endpoint, args = 'update_call', (path.rsplit('/', 1)[1], body)
+        else:
+            endpoint = next((name for m, p, name in ROUTES if m == method and p == path), None)
+            args = (body,)
+        if endpoint is None:
+            return self._send(404, {'message': f"No fake for {method} {path}"})
+
+        with hubspot.lock:
+            hubspot.requests[endpoint] += 1
+        delay = hubspot.latency_ms + random.uniform(-hubspot.jitter_ms, hubspot.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if random.random() < hubspot.rate_limit_rate:
+            status, response, headers = 429, {'message': "You have reached your secondly limit."}, {
+                'Retry-After': hubspot.retry_after}
+        elif random.random() < hubspot.error_rate:
+            status, response, headers = 502, {'message': "Injected error"}, {}
+        else:
+            status, response = getattr(hubspot, endpoint)(*args)
+            headers = {}
+        with hubspot.lock:
+            hubspot.responses[f"{endpoint} {status}"] += 1
+        self._send(status, response, headers)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+
+def serve(host="127.0.0.1", port=0, **settings):
+    """Start a fake HubSpot on a background thread. Returns (server, hubspot); server.server_port is the port."""
+    hubspot = FakeHubSpot(**settings)
+    handler = type('Handler', (FakeHubSpotHandler,), {'hubspot': hubspot})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-hubspot", daemon=True).start()
+    return server, hubspot
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="added latency per HubSpot request")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="random +/- variation of the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 502")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with injected 429s")
+
+
+def settings_from(args):
+    return {
+        'latency_ms': args.latency_ms,
+        'jitter_ms': args.jitter_ms,
+        'error_rate': args.error_rate,
+        'rate_limit_rate': args.rate_limit_rate,
+        'retry_after': args.retry_after
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server, _ = serve(args.host, args.port, **settings_from(args))
+    print(f"Fake HubSpot listening on http://{args.host}:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
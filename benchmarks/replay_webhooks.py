@@ -0,0 +1,327 @@
+"""Replay realistic Twilio webhook traffic against the connector and a fake HubSpot.
+
+Each simulated call posts /voice, then the /call-completed callback of every technician leg and
+the /call-status result of the dial, in the order Twilio tends to send them. The mix covers
+answered calls, missed calls, calls that rang several technicians and repeat callers, with many
+calls in flight at once. Once the webhooks are done the run waits until every call has reached
+HubSpot. It then reports per-route latency (p50/p95/p99), throughput, the time to drain the
+delivery queue and the HubSpot requests per call.
+
+By default the connector runs in this process against a fresh fake HubSpot:
+
+    python benchmarks/replay_webhooks.py --calls 2000 --concurrency 32 --latency-ms 80 --rate-limit-rate 0.02
+
+To measure a real deployment (e.g. gunicorn -c gunicorn.conf.py) start benchmarks/fake_hubspot.py,
+point the service's HUBSPOT_BASE_URL at it and pass --target and --hubspot-url.
+
+Results are saved to benchmarks/results/ with the current commit. --compare prints the change
+from the previous run.
+"""
+import os
+import sys
+import json
+import glob
+import logging
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fake_hubspot  # noqa: E402
+
+TWILIO_NUMBER = "+15550100000"
+TECHNICIANS = ["+15550100001", "+15550100002", "+15550100003"]
+
+
+def build_calls(count, seed, missed_rate, multi_leg_rate, repeat_rate):
+    """Generate the webhook sequence of every call as a list of (route, form) per call."""
+    rng = random.Random(seed)
+    callers = []
+    calls = []
+    for index in range(count):
+        if callers and rng.random() < repeat_rate:
+            caller = rng.choice(callers)
+        else:
+            caller = f"+1555{2000000 + index:07d}"
+            callers.append(caller)
+        call_sid = f"CA{seed:08x}{index:024x}"
+        missed = rng.random() < missed_rate
+        technicians = TECHNICIANS[:rng.choice([2, 3])] if rng.random() < multi_leg_rate else TECHNICIANS[:1]
+        duration = 0 if missed else rng.randint(20, 600)
+        common = {'From': caller, 'To': TWILIO_NUMBER, 'Direction': 'inbound', 'AccountSid': 'AC' + '0' * 32}
+
+        legs = []
+        for i, technician in enumerate(technicians):
+            answered = not missed and i == 0
+            legs.append(('/call-completed', {
+                **common,
+                'CallSid': f"{call_sid}L{i}",
+                'ParentCallSid': call_sid,
+                'Called': technician,
+                'CallStatus': 'completed' if answered else ('no-answer' if missed else 'canceled'),
+                'CallDuration': str(duration if answered else 0)
+            }))
+        rng.shuffle(legs)
+        dial = ('/call-status', {
+            **common,
+            'CallSid': call_sid,
+            'CallStatus': 'completed' if not missed else 'in-progress',
+            'DialCallSid': f"{call_sid}L0",
+            'DialCallStatus': 'no-answer' if missed else 'completed',
+            'DialCallDuration': str(duration)
+        })
+        # The dial result usually arrives after the legs report, but not always
+        sequence = legs + [dial] if rng.random() < 0.8 else [dial] + legs
+        calls.append({
+            'sid': call_sid,
+            'missed': missed,
+            'webhooks': [('/voice', {**common, 'CallSid': call_sid, 'CallStatus': 'ringing'})] + sequence
+        })
+    return calls
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+
+def start_connector(hubspot_url, workdir, args):
+    """Run the connector in this process on a threaded WSGI server. Returns its base URL."""
+    os.environ.update({
+        'HUBSPOT_API_KEY': "benchmark",
+        'HUBSPOT_BASE_URL': hubspot_url,
+        'TECHNICIAN_NUMBERS': ",".join(TECHNICIANS),
+        'ROUTING_FILE': "",
+        'BUSINESS_HOURS': "",
+        'DEDUPE_DB': os.path.join(workdir, "processed_calls.db"),
+        'CONTACT_CACHE_DB': os.path.join(workdir, "contact_cache.db"),
+        'CALL_QUEUE_DIR': os.path.join(workdir, "call_queue"),
+        'METRICS_DIR': os.path.join(workdir, "metrics"),
+        'HUBSPOT_RATE_LIMIT_DB': os.path.join(workdir, "hubspot_rate_limit.db"),
+        'CORRELATION_SETTLE': str(args.settle),
+        'LOG_LEVEL': args.log_level
+    })
+    from werkzeug.serving import make_server
+    from TwilioHubspotConnector import create_app, prepare_state
+
+    app = create_app()
+    prepare_state(app.config)
+    # The development server logs every request at INFO; that's noise at benchmark volume
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="connector", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def replay(target, calls, concurrency, ring_delay):
+    latencies = defaultdict(list)
+    failures = defaultdict(int)
+    lock = threading.Lock()
+    local = threading.local()
+
+    def run_call(call):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        for i, (route, form) in enumerate(call['webhooks']):
+            if i == 1 and ring_delay:
+                time.sleep(ring_delay)
+            started = time.perf_counter()
+            try:
+                ok = session.post(target + route, data=form, timeout=30).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[route].append(elapsed)
+                if not ok:
+                    failures[route] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_call, calls))
+    return time.perf_counter() - started, latencies, failures
+
+
+def wait_for_hubspot(hubspot_url, expected_calls, timeout):
+    """Poll the fake until every call has been logged. Returns (seconds waited, final stats)."""
+    started = time.perf_counter()
+    while True:
+        stats = requests.get(hubspot_url + "/__stats", timeout=10).json()
+        if stats['calls'] >= expected_calls or time.perf_counter() - started > timeout:
+            return time.perf_counter() - started, stats
+        time.sleep(0.2)
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def summarize(args, wall, latencies, failures, drain, stats, calls):
+    requests_sent = sum(len(values) for values in latencies.values())
+    all_latencies = [value for values in latencies.values() for value in values]
+
+    def latency_summary(values):
+        summary = {f"p{p}_ms": round(percentile(values, p) * 1000, 2) for p in (50, 95, 99)}
+        summary['requests'] = len(values)
+        return summary
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {
+            'calls': args.calls, 'concurrency': args.concurrency, 'seed': args.seed,
+            'missed_rate': args.missed_rate, 'multi_leg_rate': args.multi_leg_rate,
+            'repeat_rate': args.repeat_rate, 'ring_delay_ms': args.ring_delay_ms,
+            'hubspot': fake_hubspot.settings_from(args), 'target': args.target or "in-process"
+        },
+        'webhooks': {
+            'requests': requests_sent,
+            'failures': dict(failures),
+            'wall_seconds': round(wall, 3),
+            'throughput_rps': round(requests_sent / wall, 1),
+            'calls_per_second': round(len(calls) / wall, 1),
+            'latency': latency_summary(all_latencies),
+            'routes': {route: latency_summary(values) for route, values in sorted(latencies.items())}
+        },
+        'hubspot': {
+            'engagements': stats['calls'],
+            'expected_engagements': len(calls),
+            'drain_seconds': round(drain, 3),
+            'requests': stats['total_requests'],
+            'requests_per_call': round(stats['total_requests'] / len(calls), 3),
+            'by_endpoint': stats['requests'],
+            'responses': stats['responses']
+        }
+    }
+
+
+def save(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(RESULTS_DIR, f"{stamp}-{result['commit']}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+# (label, path into the result, lower is better)
+COMPARED = [
+    ("p50 ms", ('webhooks', 'latency', 'p50_ms'), True),
+    ("p95 ms", ('webhooks', 'latency', 'p95_ms'), True),
+    ("p99 ms", ('webhooks', 'latency', 'p99_ms'), True),
+    ("throughput rps", ('webhooks', 'throughput_rps'), False),
+    ("drain s", ('hubspot', 'drain_seconds'), True),
+    ("HubSpot requests/call", ('hubspot', 'requests_per_call'), True),
+]
+
+
+def lookup(result, path):
+    for key in path:
+        result = (result or {}).get(key)
+    return result
+
+
+def print_result(result, previous=None):
+    webhooks, hubspot = result['webhooks'], result['hubspot']
+    print(f"commit {result['commit']}: {result['parameters']['calls']} calls, "
+          f"{result['parameters']['concurrency']} concurrent, {webhooks['requests']} webhooks "
+          f"in {webhooks['wall_seconds']}s ({webhooks['throughput_rps']} req/s)")
+    print(f"{'route':<18} {'requests':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, summary in list(webhooks['routes'].items()) + [("all", webhooks['latency'])]:
+        print(f"{route:<18} {summary['requests']:>9} {summary['p50_ms']:>8} {summary['p95_ms']:>8} {summary['p99_ms']:>8}")
+    if webhooks['failures']:
+        print(f"failed webhooks: {webhooks['failures']}")
+    print(f"HubSpot: {hubspot['engagements']}/{hubspot['expected_engagements']} engagements, "
+          f"drained in {hubspot['drain_seconds']}s, {hubspot['requests']} requests "
+          f"({hubspot['requests_per_call']} per call) {hubspot['by_endpoint']}")
+
+    if previous:
+        print(f"\ncompared with {previous['commit']} ({previous['timestamp']}):")
+        for label, path, lower_is_better in COMPARED:
+            before, after = lookup(previous, path), lookup(result, path)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before * 100 if before else 0.0
+            better = (change < 0) == lower_is_better if change else None
+            verdict = "" if better is None else (" better" if better else " worse")
+            print(f"  {label:<22} {before:>10} -> {after:<10} {change:+.1f}%{verdict}")
+
+
+def previous_result(compare):
+    if compare and compare != "last":
+        with open(compare) as f:
+            return json.load(f)
+    paths = sorted(glob.glob(os.path.join(RESULTS_DIR, "*.json")))
+    if not paths:
+        return None
+    with open(paths[-1]) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32, help="calls in flight at once")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--missed-rate", type=float, default=0.3, help="fraction of calls no technician answers")
+    parser.add_argument("--multi-leg-rate", type=float, default=0.5, help="fraction of calls that ring several technicians")
+    parser.add_argument("--repeat-rate", type=float, default=0.3, help="fraction of calls from an earlier caller")
+    parser.add_argument("--ring-delay-ms", type=float, default=0.0, help="pause between /voice and the callbacks")
+    parser.add_argument("--settle", type=float, default=1.0, help="CORRELATION_SETTLE for the in-process connector")
+    parser.add_argument("--log-level", default="WARNING", help="LOG_LEVEL for the in-process connector")
+    parser.add_argument("--drain-timeout", type=float, default=300.0)
+    parser.add_argument("--target", help="base URL of an already running connector")
+    parser.add_argument("--hubspot-url", help="base URL of an already running fake_hubspot.py")
+    parser.add_argument("--no-save", action="store_true", help="don't write the result to benchmarks/results")
+    parser.add_argument("--compare", nargs="?", const="last",
+                        help="compare with a saved result file (default: the latest one)")
+    fake_hubspot.add_arguments(parser)
+    args = parser.parse_args()
+    if args.target and not args.hubspot_url:
+        parser.error("--target needs --hubspot-url, the fake HubSpot that target is configured to use")
+
+    previous = previous_result(args.compare) if args.compare else None
+
+    hubspot_url = args.hubspot_url
+    if not hubspot_url:
+        server, _ = fake_hubspot.serve(**fake_hubspot.settings_from(args))
+        hubspot_url = f"http://127.0.0.1:{server.server_port}"
+    requests.post(hubspot_url + "/__reset", json={}, timeout=10)
+
+    calls = build_calls(args.calls, args.seed, args.missed_rate, args.multi_leg_rate, args.repeat_rate)
+    with tempfile.TemporaryDirectory() as workdir:
+        target = args.target or start_connector(hubspot_url, workdir, args)
+        wall, latencies, failures = replay(target, calls, args.concurrency, args.ring_delay_ms / 1000)
+        drain, stats = wait_for_hubspot(hubspot_url, len(calls), args.drain_timeout)
+
+    result = summarize(args, wall, latencies, failures, drain, stats, calls)
+    print_result(result, previous)
+    if not args.no_save:
+        print(f"\nsaved {save(result)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Measure worker boot time against the size of the processed calls history.
+
+For each history size a processed_calls.db is filled with that many calls, then a fresh Python
+process imports the connector, calls create_app() and serves its first /voice and /call-status
+requests. Boot time should stay flat as the history grows; the legacy column shows what loading
+and rewriting an equally large processed_calls.json cost every worker before.
+
+    python benchmarks/startup_bench.py --sizes 0 10000 100000 1000000
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from dedupe_store import SqliteDedupeStore  # noqa: E402
+
+# Run in a clean interpreter so nothing is already imported or cached
+WORKER_SCRIPT = """
+import sys, time, json
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+from TwilioHubspotConnector import create_app
+app = create_app()
+booted = time.perf_counter()
+client = app.test_client()
+client.post('/voice', data={'From': '+15550000001', 'CallSid': 'CAbench'})
+client.post('/call-status', data={'From': '+15550000001', 'CallSid': 'CAbench', 'DialCallStatus': 'completed'})
+served = time.perf_counter()
+print(json.dumps({'boot': booted - started, 'first_request': served - booted}))
+"""
+
+
+def fill_history(path, size):
+    store = SqliteDedupeStore(path)
+    store.close()
+    conn = sqlite3.connect(path, isolation_level=None)
+    now = int(time.time() * 1000)
+    conn.execute("BEGIN")
+    for start in range(0, size, 10000):
+        rows = [(i, f"CA{i:032d}", f"+1555{i % 1000000:07d}", now - i) for i in range(start, min(start + 10000, size))]
+        conn.executemany("INSERT INTO calls (id, call_sid, phone, timestamp) VALUES (?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO call_sids (sid, call_id) VALUES (?, ?)", [(row[1], row[0]) for row in rows])
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def legacy_load(path, size):
+    history = {}
+    now = int(time.time() * 1000)
+    for i in range(size):
+        history.setdefault(f"+1555{i % 1000000:07d}", []).append({'call_sid': f"CA{i:032d}", 'timestamp': now - i})
+    with open(path, 'w') as f:
+        json.dump(history, f)
+    started = time.perf_counter()
+    with open(path, 'r') as f:
+        history = json.load(f)
+    with open(path, 'w') as f:
+        json.dump(history, f)
+    return time.perf_counter() - started
+
+
+def boot_once(workdir):
+    env = dict(
+        os.environ,
+        TECHNICIAN_NUMBERS="+15555550100",
+        HUBSPOT_API_KEY="",
+        DEDUPE_DB=os.path.join(workdir, "processed_calls.db"),
+        CONTACT_CACHE_DB=os.path.join(workdir, "contact_cache.db"),
+        CALL_QUEUE_DIR=os.path.join(workdir, "call_queue"),
+        METRICS_DIR=os.path.join(workdir, "metrics"),
+        HUBSPOT_RATE_LIMIT_DB=os.path.join(workdir, "hubspot_rate_limit.db"),
+        ROUTING_FILE=""
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", WORKER_SCRIPT, REPO_DIR],
+        cwd=workdir, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--legacy", action="store_true", help="also time the old processed_calls.json load and rewrite")
+    args = parser.parse_args()
+
+    header = f"{'calls':>10} {'boot ms':>10} {'first req ms':>13}"
+    print(header + (f" {'legacy json ms':>15}" if args.legacy else ""))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            fill_history(os.path.join(workdir, "processed_calls.db"), size)
+            runs = [boot_once(workdir) for _ in range(args.repeat)]
+            line = (f"{size:>10} {statistics.median(r['boot'] for r in runs) * 1000:>10.1f} "
+                    f"{statistics.median(r['first_request'] for r in runs) * 1000:>13.1f}")
+            if args.legacy:
+                line += f" {legacy_load(os.path.join(workdir, 'legacy.json'), size) * 1000:>15.1f}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import os
+import time
+import atexit
+import sqlite3
+import tempfile
+import logging
+import threading
+
+# Statuses Twilio reports for a <Dial> that never reached a technician
+UNANSWERED_DIAL_STATUSES = ["no-answer", "busy", "failed", "canceled"]
+
+# A leg has to last longer than this to count as a real conversation
+MIN_CONNECTED_SECONDS = 15
+
+# Time allowed for Twilio's callbacks to arrive after a call has ended
+CALLBACK_GRACE_SECONDS = 30
+
+# How long a worker has to emit a call before another worker takes it over
+EMIT_LEASE_SECONDS = 60
+
+
+def classify_call(dial_status=None, dial_duration=0, leg_status=None, leg_duration=0):
+    """Pick the disposition for a call from everything known about its legs.
+
+    Uses the stricter /call-completed rule (a completed leg longer than MIN_CONNECTED_SECONDS)
+    when a technician leg completed, and otherwise the /call-status rule (the dial was not
+    unanswered). A canceled or unanswered leg says nothing about the others, so it doesn't
+    override the dial result. Returns (disposition, status, duration_seconds).
+    """
+    duration = max(dial_duration or 0, leg_duration or 0)
+    if leg_status and leg_status.lower() == "completed":
+        connected = duration > MIN_CONNECTED_SECONDS
+    else:
+        connected = bool(dial_status) and dial_status.lower() not in UNANSWERED_DIAL_STATUSES
+    disposition = "CONNECTED" if connected else "NO_ANSWER"
+    status = "COMPLETED" if connected else "MISSED"
+    return disposition, status, duration
+
+
+def _rank(disposition, duration):
+    return (disposition == "CONNECTED", duration or 0)
+
+
+class CorrelatedCall:
+    def __init__(self, row, sids=()):
+        (self.root_sid, self.phone, self.first_seen, self.due_at, self.dial_status, self.dial_duration,
+         self.leg_status, self.leg_duration, self.final_seen, self.state, self.emitted_disposition,
+         self.emitted_duration, self.engagement_id) = row
+        self.sids = list(sids)
+        # Set when an earlier attempt to emit the call died before it was marked emitted
+        self.recovered = False
+
+    def classify(self):
+        return classify_call(self.dial_status, self.dial_duration, self.leg_status, self.leg_duration)
+
+
+def _rollback(conn):
+    # A failed BEGIN or COMMIT may have left no transaction open
+    if conn.in_transaction:
+        conn.execute("ROLLBACK")
+
+
+def _temporary_database():
+    # ':memory:' still gets a file: a shared-cache in-memory database fails concurrent writers with
+    # SQLITE_LOCKED straight away instead of waiting on the busy timeout like a file does
+    fd, path = tempfile.mkstemp(prefix="call_correlator-", suffix=".db")
+    os.close(fd)
+    owner = os.getpid()
+
+    def remove():
+        if os.getpid() != owner:
+            return
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+
+    atexit.register(remove)
+    return path
+
+
+_COLUMNS = ("root_sid, phone, first_seen, due_at, dial_status, dial_duration, leg_status, leg_duration, "
+            "final_seen, state, emitted_disposition, emitted_duration, engagement_id")
+
+
+class CallCorrelator:
+    """Groups the parent and technician legs of a forwarded call into one HubSpot engagement.
+
+    /call-status (the <Dial> action, keyed by CallSid/DialCallSid) and /call-completed (one per
+    technician leg, keyed by CallSid/ParentCallSid) are merged under the parent CallSid in a
+    SQLite table shared by all worker processes. A call is emitted settle seconds after the dial
+    result or a completed leg, giving the other legs time to report. A canceled or unanswered leg
+    says nothing about the rest of the call (with simultaneous ring the other technicians' legs are
+    canceled as soon as one answers), so without either the call is emitted window seconds after the
+    first event, which has to outlast the longest possible call. Better data arriving after that (a longer duration or a connected leg)
+    is emitted as an update to the same engagement instead of a second one. A call marked with
+    skip() will never have an engagement, so late data for it is dropped.
+    """
+
+    def __init__(self, path, emit, update, window=660.0, settle=5.0, poll_interval=1.0):
+        if path == ":memory:":
+            path = _temporary_database()
+        self.path = path
+        self.emit = emit
+        self.update = update
+        self.window = window
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._thread = None
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS correlated_calls (
+                root_sid TEXT PRIMARY KEY,
+                phone TEXT,
+                first_seen INTEGER NOT NULL,
+                due_at REAL NOT NULL,
+                dial_status TEXT,
+                dial_duration INTEGER NOT NULL DEFAULT 0,
+                leg_status TEXT,
+                leg_duration INTEGER NOT NULL DEFAULT 0,
+                final_seen INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL DEFAULT 'pending',
+                emitted_disposition TEXT,
+                emitted_duration INTEGER,
+                engagement_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS correlated_calls_due ON correlated_calls (state, due_at);
+            CREATE INDEX IF NOT EXISTS correlated_calls_first_seen ON correlated_calls (first_seen);
+            CREATE TABLE IF NOT EXISTS correlated_sids (
+                sid TEXT PRIMARY KEY,
+                root_sid TEXT NOT NULL REFERENCES correlated_calls (root_sid) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS correlated_sids_root ON correlated_sids (root_sid);
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _load(self, conn, root_sid):
+        row = conn.execute(f"SELECT {_COLUMNS} FROM correlated_calls WHERE root_sid = ?", (root_sid,)).fetchone()
+        if row is None:
+            return None
+        sids = [sid for (sid,) in conn.execute("SELECT sid FROM correlated_sids WHERE root_sid = ?", (root_sid,))]
+        return CorrelatedCall(row, sids)
+
+    def record_dial(self, call_sid, phone, dial_status, dial_call_sid=None, dial_duration=0):
+        """Record the <Dial> action callback. The dial is over, so the call settles soon."""
+        self._record(call_sid, [dial_call_sid], phone=phone, dial_status=dial_status,
+                     dial_duration=dial_duration, final=True)
+
+    def record_leg(self, parent_call_sid, call_sid, phone, leg_status, leg_duration=0):
+        """Record a technician leg's completed status callback. Only an answered leg settles the call."""
+        self._record(parent_call_sid or call_sid, [call_sid], phone=phone, leg_status=leg_status,
+                     leg_duration=leg_duration, final=False, settle=(leg_status or "").lower() == "completed")
+
+    def _record(self, root_sid, sids, phone, final, settle=True, dial_status=None, dial_duration=0, leg_status=None,
+                leg_duration=0):
+        now = time.time()
+        sids = [sid for sid in sids if sid and sid != root_sid]
+        late_update = None
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            call = self._load(conn, root_sid)
+            if call is None:
+                conn.execute(
+                    "INSERT INTO correlated_calls (root_sid, phone, first_seen, due_at) VALUES (?, ?, ?, ?)",
+                    (root_sid, phone, int(now * 1000), now + self.window)
+                )
+                call = self._load(conn, root_sid)
+
+            call.phone = call.phone or phone
+            if dial_status:
+                call.dial_status = dial_status
+            call.dial_duration = max(call.dial_duration, dial_duration or 0)
+            if leg_status and (call.leg_status or "").lower() != "completed":
+                call.leg_status = leg_status
+            call.leg_duration = max(call.leg_duration, leg_duration or 0)
+            if final:
+                call.final_seen = 1
+            # A call being emitted keeps its lease; what this adds is sent as an update once it's emitted
+            if settle and call.state == 'pending':
+                call.due_at = min(call.due_at, now + self.settle)
+
+            if call.state == 'emitted':
+                disposition, status, duration = call.classify()
+                if _rank(disposition, duration) > _rank(call.emitted_disposition, call.emitted_duration):
+                    call.emitted_disposition, call.emitted_duration = disposition, duration
+                    late_update = call
+
+            conn.execute(
+                "UPDATE correlated_calls SET phone = ?, due_at = ?, dial_status = ?, dial_duration = ?, leg_status = ?, "
+                "leg_duration = ?, final_seen = ?, emitted_disposition = ?, emitted_duration = ? WHERE root_sid = ?",
+                (call.phone, call.due_at, call.dial_status, call.dial_duration, call.leg_status, call.leg_duration,
+                 call.final_seen, call.emitted_disposition, call.emitted_duration, root_sid)
+            )
+            conn.executemany("INSERT OR IGNORE INTO correlated_sids (sid, root_sid) VALUES (?, ?)",
+                             [(sid, root_sid) for sid in sids])
+            if late_update:
+                late_update.sids = sorted(set(call.sids) | set(sids))
+            conn.execute("COMMIT")
+        except Exception:
+            _rollback(conn)
+            raise
+
+        if late_update:
+            logging.info(f"Late data for call {root_sid}, updating engagement")
+            self.update(late_update)
+
+    def skip(self, root_sid):
+        """Record that an emitted call gets no engagement from us (already logged, or given up on)."""
+        self._conn().execute("UPDATE correlated_calls SET state = 'skipped' WHERE root_sid = ? AND engagement_id IS NULL",
+                             (root_sid,))
+
+    def is_skipped(self, root_sid):
+        row = self._conn().execute("SELECT state FROM correlated_calls WHERE root_sid = ?", (root_sid,)).fetchone()
+        return row is not None and row[0] == 'skipped'
+
+    def set_engagement(self, root_sid, engagement_id):
+        self._conn().execute("UPDATE correlated_calls SET engagement_id = ? WHERE root_sid = ?", (engagement_id, root_sid))
+
+    def engagement_id(self, root_sid):
+        row = self._conn().execute("SELECT engagement_id FROM correlated_calls WHERE root_sid = ?", (root_sid,)).fetchone()
+        return row[0] if row else None
+
+    def flush_due(self, now=None):
+        """Emit every call whose wait is over. Returns the number emitted by this process.
+
+        A call is leased ('emitting') while emit() claims and journals it, and only marked emitted
+        afterwards, so a worker that dies in between leaves it for the next poll to emit again.
+        """
+        now = time.time() if now is None else now
+        conn = self._conn()
+        due = [root for (root,) in conn.execute(
+            "SELECT root_sid FROM correlated_calls WHERE state IN ('pending', 'emitting') AND due_at <= ?", (now,)
+        )]
+        emitted = 0
+        for root_sid in due:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                call = self._load(conn, root_sid)
+                # Another worker may have emitted or leased it between our SELECT and this transaction
+                if call is None or call.state not in ('pending', 'emitting') or call.due_at > now:
+                    conn.execute("COMMIT")
+                    continue
+                call.recovered = call.state == 'emitting'
+                disposition, _, duration = call.classify()
+                conn.execute(
+                    "UPDATE correlated_calls SET state = 'emitting', due_at = ?, emitted_disposition = ?, "
+                    "emitted_duration = ? WHERE root_sid = ?", (now + EMIT_LEASE_SECONDS, disposition, duration, root_sid)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                _rollback(conn)
+                raise
+            try:
+                self.emit(call)
+            except Exception as e:
+                # Put it back so the next poll (here or in another worker) tries again
+                logging.error(f"Error emitting correlated call {root_sid}: {e}")
+                conn.execute("UPDATE correlated_calls SET state = 'pending' WHERE root_sid = ? AND state = 'emitting'",
+                             (root_sid,))
+                continue
+            self._mark_emitted(conn, root_sid)
+            emitted += 1
+        return emitted
+
+    def _mark_emitted(self, conn, root_sid):
+        late_update = None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            call = self._load(conn, root_sid)
+            # emit() may have skipped it instead
+            if call is not None and call.state == 'emitting':
+                conn.execute("UPDATE correlated_calls SET state = 'emitted' WHERE root_sid = ?", (root_sid,))
+                # Legs that reported while it was being emitted were merged but not sent
+                disposition, _, duration = call.classify()
+                if _rank(disposition, duration) > _rank(call.emitted_disposition, call.emitted_duration):
+                    conn.execute(
+                        "UPDATE correlated_calls SET emitted_disposition = ?, emitted_duration = ? WHERE root_sid = ?",
+                        (disposition, duration, root_sid)
+                    )
+                    late_update = call
+            conn.execute("COMMIT")
+        except Exception:
+            _rollback(conn)
+            raise
+        if late_update:
+            logging.info(f"Late data for call {root_sid}, updating engagement")
+            self.update(late_update)
+
+    def expire(self, cutoff_timestamp, limit=500):
+        """Drop up to limit emitted or skipped calls first seen at or before cutoff_timestamp (ms)."""
+        return self._conn().execute(
+            "DELETE FROM correlated_calls WHERE root_sid IN ("
+            "SELECT root_sid FROM correlated_calls WHERE state IN ('emitted', 'skipped') AND first_seen <= ? "
+            "ORDER BY first_seen LIMIT ?)",
+            (cutoff_timestamp, limit)
+        ).rowcount
+
+    def start(self):
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="call-correlator", daemon=True)
+            self._thread.start()
+            self._started_pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._started_pid = None
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.flush_due()
+            except Exception as e:
+                logging.error(f"Call correlation flush failed: {e}")
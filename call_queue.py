@@ -0,0 +1,300 @@
+import os
+import json
+import time
+import uuid
+import heapq
+import random
+import logging
+import threading
+
+from metrics import STORE_WRITE_SECONDS, CALL_QUEUE_RETRIES, CALL_QUEUE_DEAD_LETTERS
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development only
+    fcntl = None
+
+# Journal file name pattern; one journal per process so gunicorn workers never share a file
+JOURNAL_PREFIX = "journal."
+JOURNAL_SUFFIX = ".jsonl"
+
+# Rewrite the journal once this many acknowledged entries have piled up
+COMPACT_AFTER_ACKS = 1000
+
+
+def _lock_file(f, blocking=True):
+    if fcntl is None:
+        return True
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    try:
+        fcntl.flock(f.fileno(), flags)
+        return True
+    except OSError:
+        return False
+
+
+def _lock_journal(path, blocking=True):
+    """Open and lock the journal at path, or return None if it is gone or held by a live process.
+
+    Whoever replaces or removes a journal holds its lock while doing so, so once the path is
+    checked to still point at the file we locked, it stays ours until we close it.
+    """
+    try:
+        f = open(path, 'r+')
+    except FileNotFoundError:
+        return None
+    try:
+        if _lock_file(f, blocking) and os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+            return f
+    except FileNotFoundError:
+        pass
+    f.close()
+    return None
+
+
+def _write_locked_journal(path, entries):
+    """Write entries to a new journal at path and return it open and locked.
+
+    The file is locked under a temporary name and only then renamed into place, so another
+    process never sees an unlocked journal at path and mistakes it for an orphan.
+    """
+    tmp_path = path + ".tmp"
+    journal = open(tmp_path, 'w')
+    _lock_file(journal)
+    for entry in entries:
+        journal.write(json.dumps({'op': 'put', **entry}) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+    os.replace(tmp_path, path)
+    return journal
+
+
+def _read_pending(path):
+    """Return the events in a journal file that were put but never acknowledged, in order."""
+    pending = {}
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A torn final line from a crash mid-write; everything before it is intact
+                continue
+            if entry.get('op') == 'put':
+                pending[entry['id']] = entry
+            elif entry.get('op') == 'ack':
+                pending.pop(entry['id'], None)
+    return list(pending.values())
+
+
+class CallEventQueue:
+    """Durable, at-least-once queue that delivers call events from background worker threads.
+
+    Every event is appended to an on-disk journal before enqueue() returns and is only
+    acknowledged once deliver(event) reports success. Events that keep failing are moved
+    to a dead-letter file after max_attempts tries, and passed to on_dead_letter(event) if given.
+    """
+
+    def __init__(self, deliver, journal_dir="call_queue", workers=4, max_attempts=8,
+                 backoff_base=2.0, backoff_max=300.0, fsync=True, on_dead_letter=None):
+        self.deliver = deliver
+        self.on_dead_letter = on_dead_letter
+        self.journal_dir = journal_dir
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.fsync = fsync
+        self.dead_letter_path = os.path.join(journal_dir, "dead_letter.jsonl")
+
+        self._ready = []  # heap of (ready_at, seq, entry)
+        self._seq = 0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._journal = None
+        self._journal_path = None
+        self._acks_since_compact = 0
+        self._threads = []
+        self._started_pid = None
+        self._stopping = False
+
+    def start(self):
+        """Open this process's journal, recover orphaned journals and start the workers.
+
+        Safe to call repeatedly; it is a no-op unless the queue has not been started in
+        the current process (threads do not survive a gunicorn fork).
+        """
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._start()
+            self._started_pid = os.getpid()
+
+    def _start(self):
+        with self._cond:
+            self._stopping = False
+            self._ready = []
+            self._in_flight = 0
+        self._threads = []
+
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._journal_path = os.path.join(self.journal_dir, f"{JOURNAL_PREFIX}{os.getpid()}{JOURNAL_SUFFIX}")
+        # Whatever is in our own file belongs to a dead process that happened to share our pid.
+        # Keep it locked until our journal replaces it so no other process adopts it meanwhile.
+        stale = _lock_journal(self._journal_path)
+        recovered = _read_pending(self._journal_path) if stale else []
+        recovered.extend(self._adopt_orphaned_journals())
+        with self._journal_lock:
+            self._journal = _write_locked_journal(self._journal_path, recovered)
+        if stale:
+            stale.close()
+
+        for entry in recovered:
+            self._schedule(entry, 0)
+        if recovered:
+            logging.info(f"Recovered {len(recovered)} undelivered call events from journal")
+
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"call-queue-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _adopt_orphaned_journals(self):
+        # A journal whose lock we can take has no live owner, so its pending events are ours now
+        adopted = []
+        for name in os.listdir(self.journal_dir):
+            path = os.path.join(self.journal_dir, name)
+            if (not name.startswith(JOURNAL_PREFIX) or not name.endswith(JOURNAL_SUFFIX)
+                    or path == self._journal_path):
+                continue
+            try:
+                f = _lock_journal(path, blocking=False)
+                if f is None:
+                    continue
+                with f:
+                    adopted.extend(_read_pending(path))
+                    os.remove(path)
+            except OSError as e:
+                logging.error(f"Could not recover call queue journal {path}: {e}")
+        return adopted
+
+    def enqueue(self, event):
+        """Persist an event and hand it to the workers. Returns the event id."""
+        self.start()
+        entry = {'id': uuid.uuid4().hex, 'event': event, 'attempts': 0}
+        self._append({'op': 'put', **entry}, sync=self.fsync)
+        self._schedule(entry, 0)
+        return entry['id']
+
+    def depth(self):
+        """Number of events waiting for delivery or currently being delivered."""
+        with self._cond:
+            return len(self._ready) + self._in_flight
+
+    def stop(self, timeout=10.0):
+        """Stop the workers after in-flight deliveries finish. Pending events stay in the journal."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        with self._journal_lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+        with self._start_lock:
+            self._started_pid = None
+
+    def _append(self, record, sync=False):
+        with self._journal_lock, STORE_WRITE_SECONDS.time(store="journal"):
+            self._journal.write(json.dumps(record) + "\n")
+            self._journal.flush()
+            if sync:
+                os.fsync(self._journal.fileno())
+
+    def _schedule(self, entry, delay):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._ready, (time.monotonic() + delay, self._seq, entry))
+            self._cond.notify()
+
+    def _next(self):
+        with self._cond:
+            while not self._stopping:
+                if self._ready:
+                    wait = self._ready[0][0] - time.monotonic()
+                    if wait <= 0:
+                        self._in_flight += 1
+                        return heapq.heappop(self._ready)[2]
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+            return None
+
+    def _worker(self):
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+            try:
+                self._process(entry)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+
+    def _process(self, entry):
+        error = None
+        try:
+            delivered = self.deliver(entry['event'])
+        except Exception as e:
+            delivered = False
+            error = str(e)
+
+        if delivered:
+            self._ack(entry['id'])
+            return
+
+        entry['attempts'] += 1
+        if entry['attempts'] >= self.max_attempts:
+            self._dead_letter(entry, error)
+            return
+
+        delay = min(self.backoff_max, self.backoff_base ** entry['attempts'])
+        delay *= random.uniform(0.5, 1.0)
+        CALL_QUEUE_RETRIES.inc()
+        logging.warning(f"Delivery of call event {entry['id']} failed (attempt {entry['attempts']}), "
+                        f"retrying in {delay:.1f}s: {error or 'delivery returned False'}")
+        self._schedule(entry, delay)
+
+    def _ack(self, entry_id):
+        self._append({'op': 'ack', 'id': entry_id})
+        with self._journal_lock:
+            self._acks_since_compact += 1
+            if self._acks_since_compact >= COMPACT_AFTER_ACKS:
+                self._compact()
+
+    def _dead_letter(self, entry, error):
+        logging.error(f"Giving up on call event {entry['id']} after {entry['attempts']} attempts, "
+                      f"moving to dead letter: {entry['event']}")
+        CALL_QUEUE_DEAD_LETTERS.inc()
+        record = {**entry, 'error': error, 'failed_at': int(time.time() * 1000)}
+        with self._journal_lock:
+            with open(self.dead_letter_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        self._ack(entry['id'])
+        if self.on_dead_letter:
+            try:
+                self.on_dead_letter(entry['event'])
+            except Exception as e:
+                logging.error(f"Dead letter handler failed for call event {entry['id']}: {e}")
+
+    def _compact(self):
+        # Caller holds _journal_lock
+        self._journal.flush()
+        new_journal = _write_locked_journal(self._journal_path, _read_pending(self._journal_path))
+        self._journal.close()
+        self._journal = new_journal
+        self._acks_since_compact = 0
+
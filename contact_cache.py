@@ -0,0 +1,192 @@
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+# How long a process may take to create a contact before another one is allowed to try
+CREATE_LEASE_SECONDS = 15
+
+
+class SqliteContactStore:
+    """Phone -> contact ID map in a SQLite file, shared by every worker process on the host.
+
+    Also hands out short creation leases so two processes that miss on the same new caller
+    don't both create a contact.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS contacts ("
+            "phone TEXT PRIMARY KEY, contact_id TEXT, expires_at REAL NOT NULL, lease_until REAL NOT NULL DEFAULT 0)"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def get(self, phone):
+        """Return (found, contact_id); contact_id is None for a cached "no such contact"."""
+        row = self._conn().execute(
+            "SELECT contact_id, expires_at FROM contacts WHERE phone = ?", (phone,)
+        ).fetchone()
+        if row is None or row[1] <= time.time():
+            return False, None
+        return True, row[0]
+
+    def set(self, phone, contact_id, ttl):
+        self._conn().execute(
+            "INSERT INTO contacts (phone, contact_id, expires_at, lease_until) VALUES (?, ?, ?, 0) "
+            "ON CONFLICT(phone) DO UPDATE SET contact_id = excluded.contact_id, expires_at = excluded.expires_at, "
+            "lease_until = CASE WHEN excluded.contact_id IS NULL THEN contacts.lease_until ELSE 0 END",
+            (phone, contact_id, time.time() + ttl)
+        )
+
+    def delete(self, phone):
+        self._conn().execute("DELETE FROM contacts WHERE phone = ?", (phone,))
+
+    def acquire_create_lease(self, phone, seconds=CREATE_LEASE_SECONDS):
+        """Try to become the one process allowed to create a contact for this number."""
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO contacts (phone, contact_id, expires_at, lease_until) VALUES (?, NULL, 0, ?) "
+            "ON CONFLICT(phone) DO UPDATE SET lease_until = excluded.lease_until "
+            "WHERE contacts.lease_until <= ? AND (contacts.contact_id IS NULL OR contacts.expires_at <= ?)",
+            (phone, now + seconds, now, now)
+        )
+        return cursor.rowcount == 1
+
+
+class ContactCache:
+    """In-process LRU of E.164 number -> HubSpot contact ID with TTLs.
+
+    A "no contact" answer from search is cached as a negative entry for negative_ttl seconds.
+    An optional shared store extends the cache across processes and hands out the creation
+    leases that keep two processes from creating a contact for the same number.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, negative_ttl=60, store=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store = store
+        self._entries = OrderedDict()  # phone -> (contact_id, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.store_hits = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'store_hits': self.store_hits
+            }
+
+    def _get_local(self, phone):
+        # Caller holds _lock
+        entry = self._entries.get(phone)
+        if entry is None:
+            return False, None
+        if entry[1] <= time.monotonic():
+            del self._entries[phone]
+            return False, None
+        self._entries.move_to_end(phone)
+        return True, entry[0]
+
+    def _put_local(self, phone, contact_id):
+        ttl = self.ttl if contact_id else self.negative_ttl
+        with self._lock:
+            self._entries[phone] = (contact_id, time.monotonic() + ttl)
+            self._entries.move_to_end(phone)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def put(self, phone, contact_id):
+        self._put_local(phone, contact_id)
+        if self.store:
+            try:
+                self.store.set(phone, contact_id, self.ttl if contact_id else self.negative_ttl)
+            except sqlite3.Error as e:
+                logging.warning(f"Contact cache store write failed for {phone}: {e}")
+
+    def invalidate(self, phone):
+        with self._lock:
+            self._entries.pop(phone, None)
+        if self.store:
+            try:
+                self.store.delete(phone)
+            except sqlite3.Error as e:
+                logging.warning(f"Contact cache store delete failed for {phone}: {e}")
+
+    def _cached(self, phone):
+        with self._lock:
+            found, contact_id = self._get_local(phone)
+            if found:
+                if contact_id:
+                    self.hits += 1
+                else:
+                    self.negative_hits += 1
+                return True, contact_id
+        if self.store:
+            try:
+                found, contact_id = self.store.get(phone)
+            except sqlite3.Error as e:
+                logging.warning(f"Contact cache store read failed for {phone}: {e}")
+                found = False
+            if found:
+                self._put_local(phone, contact_id)
+                with self._lock:
+                    self.store_hits += 1
+                return True, contact_id
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def peek(self, phone):
+        """Return (found, contact_id) from the cache without calling HubSpot."""
+        return self._cached(phone)
+
+    def refresh(self, phone):
+        """Drop this process's entry for phone and return (found, contact_id) from the shared store."""
+        with self._lock:
+            self._entries.pop(phone, None)
+        return self._cached(phone)
+
+    def begin_create(self, phone):
+        """Return True if this process may create the contact for phone right now.
+
+        Always True without a shared store; otherwise the caller must hold the store's creation lease.
+        """
+        if not self.store:
+            return True
+        try:
+            return self.store.acquire_create_lease(phone)
+        except sqlite3.Error as e:
+            logging.warning(f"Contact cache store lease failed for {phone}: {e}")
+            return True
+
+    def abort_create(self, phone):
+        """Give up the creation lease for phone after a failed create.
+
+        Dropping the number's shared entry releases the lease. HubSpot may have created the
+        contact anyway, so any cached "no contact" goes too and the next attempt searches again.
+        """
+        self.invalidate(phone)
@@ -0,0 +1,422 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import heapq
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+
+
+# Width of the time buckets the in-memory store expires calls by
+BUCKET_MS = 60 * 60 * 1000
+
+# Bytes of the SQLite file each connection memory-maps, so workers read pages straight from the
+# shared page cache instead of copying them into per-process buffers
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+class DedupeStore(ABC):
+    """Records which Twilio calls have already been sent to HubSpot.
+
+    A call is stored once under its own CallSid and indexed by every related SID seen with it
+    (DialCallSid, ParentCallSid), so any leg of an already processed call is recognised in O(1).
+    Only the newest max_per_number calls are kept per phone number; the cap is enforced as
+    calls are claimed, and time-based retention is applied incrementally through expire().
+    """
+
+    max_per_number = 100
+
+    @abstractmethod
+    def claim(self, phone, call_sid, related_sids=(), timestamp=None):
+        """Atomically record the call unless it or a related SID is already known.
+
+        Returns True if this caller now owns the call, False if it was already processed.
+        """
+
+    @abstractmethod
+    def release(self, call_sid):
+        """Forget a claimed call, e.g. because queueing it for delivery failed."""
+
+    @abstractmethod
+    def is_processed(self, *sids):
+        """Return True if any of the SIDs belongs to a call that was already claimed."""
+
+    @abstractmethod
+    def expire(self, cutoff_timestamp, limit=500):
+        """Drop up to limit calls recorded at or before cutoff_timestamp (ms), oldest first.
+
+        Returns the number of calls removed; fewer than limit means nothing older is left.
+        """
+
+    def acquire_sweep_lease(self, seconds):
+        """Return True if this process should run the next expiry sweep."""
+        return True
+
+    @abstractmethod
+    def count(self):
+        """Return the number of calls currently recorded."""
+
+    def compact(self):
+        """Leave the store in its most compact on-disk form, ready for workers to open."""
+
+    def close(self):
+        """Release this thread's handle on the store."""
+
+    def migrate_json(self, json_path):
+        """Import a legacy processed_calls.json. Returns the number of calls imported."""
+        if not os.path.exists(json_path):
+            return 0
+        with open(json_path, 'r') as f:
+            legacy = json.load(f)
+        return sum(
+            1 for phone, records in legacy.items() for record in records
+            if record.get('call_sid') and self.claim(phone, record['call_sid'], timestamp=record.get('timestamp', 0))
+        )
+
+
+class MemoryDedupeStore(DedupeStore):
+    """Single-process store for development; state is lost on restart.
+
+    Calls are kept in a bounded per-number ring and in hourly time buckets, so both the cap
+    and expiry cost O(1) per removed call.
+    """
+
+    def __init__(self, max_per_number=100):
+        self.max_per_number = max_per_number
+        self._calls = {}    # call_sid -> (phone, timestamp, sids)
+        self._sids = {}     # any sid -> call_sid
+        self._by_phone = {}  # phone -> deque of call_sids, oldest first
+        self._buckets = {}  # bucket -> set of call_sids
+        self._bucket_heap = []
+        self._lock = threading.Lock()
+
+    def claim(self, phone, call_sid, related_sids=(), timestamp=None):
+        sids = {call_sid, *(sid for sid in related_sids if sid)}
+        timestamp = int(time.time() * 1000) if timestamp is None else timestamp
+        with self._lock:
+            if any(sid in self._sids for sid in sids):
+                return False
+            self._calls[call_sid] = (phone, timestamp, sids)
+            for sid in sids:
+                self._sids[sid] = call_sid
+
+            bucket = timestamp // BUCKET_MS
+            if bucket not in self._buckets:
+                self._buckets[bucket] = set()
+                heapq.heappush(self._bucket_heap, bucket)
+            self._buckets[bucket].add(call_sid)
+
+            ring = self._by_phone.setdefault(phone, deque())
+            ring.append(call_sid)
+            while len(ring) > self.max_per_number:
+                self._remove(ring[0])
+            return True
+
+    def release(self, call_sid):
+        with self._lock:
+            self._remove(call_sid)
+
+    def _remove(self, call_sid):
+        # Caller holds _lock
+        record = self._calls.pop(call_sid, None)
+        if not record:
+            return
+        phone, timestamp, sids = record
+        for sid in sids:
+            if self._sids.get(sid) == call_sid:
+                del self._sids[sid]
+        ring = self._by_phone.get(phone)
+        if ring:
+            if ring[0] == call_sid:
+                ring.popleft()
+            else:
+                ring.remove(call_sid)
+            if not ring:
+                del self._by_phone[phone]
+        bucket = self._buckets.get(timestamp // BUCKET_MS)
+        if bucket is not None:
+            bucket.discard(call_sid)
+
+    def is_processed(self, *sids):
+        with self._lock:
+            return any(sid in self._sids for sid in sids if sid)
+
+    def expire(self, cutoff_timestamp, limit=500):
+        # Whole buckets are dropped once they end before the cutoff, so a call may outlive
+        # the retention period by up to one bucket width
+        removed = 0
+        with self._lock:
+            while self._bucket_heap and removed < limit:
+                bucket = self._bucket_heap[0]
+                if (bucket + 1) * BUCKET_MS > cutoff_timestamp:
+                    break
+                call_sids = self._buckets[bucket]
+                while call_sids and removed < limit:
+                    self._remove(next(iter(call_sids)))
+                    removed += 1
+                if not call_sids:
+                    heapq.heappop(self._bucket_heap)
+                    del self._buckets[bucket]
+        return removed
+
+    def count(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class SqliteDedupeStore(DedupeStore):
+    """Dedupe store in a SQLite database in WAL mode, safe to share between gunicorn workers.
+
+    Each claim is one small transaction appended to the WAL instead of a rewrite of the whole
+    history, and the SID primary key makes lookups an index probe.
+    """
+
+    def __init__(self, path, max_per_number=100):
+        self.path = path
+        self.max_per_number = max_per_number
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (
+                id INTEGER PRIMARY KEY,
+                call_sid TEXT NOT NULL UNIQUE,
+                phone TEXT NOT NULL,
+                timestamp INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS calls_phone_timestamp ON calls (phone, timestamp);
+            CREATE INDEX IF NOT EXISTS calls_timestamp ON calls (timestamp);
+            CREATE TABLE IF NOT EXISTS call_sids (
+                sid TEXT PRIMARY KEY,
+                call_id INTEGER NOT NULL REFERENCES calls (id) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS call_sids_call_id ON call_sids (call_id);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def claim(self, phone, call_sid, related_sids=(), timestamp=None):
+        sids = [call_sid] + [sid for sid in related_sids if sid and sid != call_sid]
+        with self._transaction() as conn:
+            placeholders = ",".join("?" * len(sids))
+            if conn.execute(f"SELECT 1 FROM call_sids WHERE sid IN ({placeholders}) LIMIT 1", sids).fetchone():
+                return False
+            call_id = conn.execute(
+                "INSERT INTO calls (call_sid, phone, timestamp) VALUES (?, ?, ?)",
+                (call_sid, phone, int(time.time() * 1000) if timestamp is None else timestamp)
+            ).lastrowid
+            conn.executemany("INSERT INTO call_sids (sid, call_id) VALUES (?, ?)", [(sid, call_id) for sid in sids])
+            self._trim_phone(conn, phone)
+            return True
+
+    def _trim_phone(self, conn, phone):
+        # Walks the (phone, timestamp) index from the newest call, so this only touches
+        # max_per_number rows plus whatever it deletes
+        conn.execute(
+            "DELETE FROM calls WHERE id IN ("
+            "SELECT id FROM calls WHERE phone = ? ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?)",
+            (phone, self.max_per_number)
+        )
+
+    def release(self, call_sid):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM calls WHERE call_sid = ?", (call_sid,))
+
+    def is_processed(self, *sids):
+        sids = [sid for sid in sids if sid]
+        if not sids:
+            return False
+        placeholders = ",".join("?" * len(sids))
+        return self._conn().execute(
+            f"SELECT 1 FROM call_sids WHERE sid IN ({placeholders}) LIMIT 1", sids
+        ).fetchone() is not None
+
+    def expire(self, cutoff_timestamp, limit=500):
+        with self._transaction() as conn:
+            return conn.execute(
+                "DELETE FROM calls WHERE id IN ("
+                "SELECT id FROM calls WHERE timestamp <= ? ORDER BY timestamp LIMIT ?)",
+                (cutoff_timestamp, limit)
+            ).rowcount
+
+    def acquire_sweep_lease(self, seconds):
+        # Every worker runs a sweeper; only the one that wins the lease does the work
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'sweep_lease_until'").fetchone()
+            if row and float(row[0]) > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('sweep_lease_until', ?)", (str(now + seconds),))
+            return True
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+
+    def compact(self):
+        # Fold the WAL back into the database file so a worker opening it has no log to replay,
+        # and refresh the planner statistics for the indexes
+        conn = self._conn()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA optimize")
+
+    def migrate_json(self, json_path):
+        """Import a legacy processed_calls.json once, then rename it out of the way.
+
+        Returns the number of calls imported. Safe to run from several processes at once.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        imported = 0
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone() is None:
+                try:
+                    with open(json_path, 'r') as f:
+                        legacy = json.load(f)
+                except (OSError, ValueError) as e:
+                    logging.error(f"Could not read {json_path} for migration: {e}")
+                    legacy = {}
+                for phone, records in legacy.items():
+                    for record in records:
+                        call_sid = record.get('call_sid')
+                        if not call_sid:
+                            continue
+                        cursor = conn.execute(
+                            "INSERT OR IGNORE INTO calls (call_sid, phone, timestamp) VALUES (?, ?, ?)",
+                            (call_sid, phone, record.get('timestamp', 0))
+                        )
+                        if cursor.rowcount:
+                            conn.execute("INSERT OR IGNORE INTO call_sids (sid, call_id) VALUES (?, ?)",
+                                         (call_sid, cursor.lastrowid))
+                            imported += 1
+                    self._trim_phone(conn, phone)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(int(time.time())),))
+        try:
+            os.replace(json_path, json_path + ".migrated")
+        except OSError:
+            pass
+        if imported:
+            logging.info(f"Migrated {imported} call records from {json_path} to {self.path}")
+        return imported
+
+
+class _Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front so check-then-insert is atomic across processes
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+class ExpirySweeper:
+    """Background thread that applies time-based retention to a DedupeStore in small batches.
+
+    Anything else with an expire(cutoff_timestamp, limit) method, such as the call correlator,
+    can be passed in also_expire to share the same retention. Keeps counters of evicted
+    records and sweep durations for monitoring.
+    """
+
+    def __init__(self, store, retention_days, interval=300, batch_size=500, also_expire=()):
+        self.store = store
+        self.also_expire = list(also_expire)
+        self.retention_ms = int(retention_days * 24 * 60 * 60 * 1000)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sweeps = 0
+        self.evicted_total = 0
+        self.last_evicted = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started_pid = None
+
+    def stats(self):
+        return {
+            'sweeps': self.sweeps,
+            'evicted_total': self.evicted_total,
+            'last_evicted': self.last_evicted,
+            'last_duration_seconds': self.last_duration,
+            'total_duration_seconds': self.total_duration
+        }
+
+    def start(self):
+        if self._started_pid == os.getpid():
+            return
+        self._started_pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="dedupe-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self._started_pid = None
+
+    def _run(self):
+        while True:
+            try:
+                if self.store.acquire_sweep_lease(self.interval * 0.9):
+                    self.sweep()
+            except Exception as e:
+                logging.error(f"Processed calls sweep failed: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def sweep(self):
+        """Expire everything past the retention period. Returns the number of calls removed."""
+        started = time.monotonic()
+        cutoff = int(time.time() * 1000) - self.retention_ms
+        evicted = 0
+        for target in [self.store] + self.also_expire:
+            while not self._stop.is_set():
+                removed = target.expire(cutoff, self.batch_size)
+                evicted += removed
+                if removed < self.batch_size:
+                    break
+        duration = time.monotonic() - started
+
+        self.sweeps += 1
+        self.evicted_total += evicted
+        self.last_evicted = evicted
+        self.last_duration = duration
+        self.total_duration += duration
+        if evicted:
+            logging.info(f"Expired {evicted} processed call records in {duration * 1000:.1f}ms")
+        return evicted
+
+
+def create_dedupe_store(path, max_per_number=100):
+    """Build the configured store: ':memory:' for a throwaway in-process store, otherwise a SQLite file."""
+    if path == ":memory:":
+        return MemoryDedupeStore(max_per_number)
+    return SqliteDedupeStore(path, max_per_number)
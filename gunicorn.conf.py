@@ -0,0 +1,18 @@
+# gunicorn -c gunicorn.conf.py TwilioHubspotConnector:app
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+
+
+def on_starting(server):
+    # Runs once in the master before any worker is forked: import the legacy JSON history,
+    # expire old records and checkpoint the database, so workers don't each repeat it
+    from TwilioHubspotConnector import load_config, prepare_state
+    prepare_state(load_config())
+
+
+def post_worker_init(worker):
+    # Start the queue, correlator and sweeper as soon as the worker is up, so journaled
+    # events are delivered without waiting for the first webhook
+    worker.wsgi.extensions['connector'].start()
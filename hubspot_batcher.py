@@ -0,0 +1,205 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+from hubspot_client import HubSpotError
+
+# Statuses with which HubSpot rejects a batch for a bad input rather than failing to process it
+REJECTED_INPUT_STATUSES = (400, 422)
+
+
+class _PendingCall:
+    def __init__(self, key, caller_id, properties):
+        self.key = key
+        self.caller_id = caller_id
+        self.properties = properties
+        self.done = threading.Event()
+        self.call_id = None
+        # A caller that times out abandons the call unless a flush has already started writing it
+        self.lock = threading.Lock()
+        self.abandoned = False
+        self.writing = False
+
+    def abandon(self):
+        """Give up on the call. Returns False if it is already being written and must be waited for."""
+        with self.lock:
+            if not self.writing:
+                self.abandoned = True
+            return self.abandoned
+
+    def start_writing(self):
+        """Returns False if the caller has given up on the call, so it must not be written."""
+        with self.lock:
+            if not self.abandoned:
+                self.writing = True
+            return self.writing
+
+
+class CallBatcher:
+    """Collects concurrent call writes into micro-batches for HubSpot's batch APIs.
+
+    log_call() blocks until its call has been written. A flush happens once max_batch_size
+    calls are waiting or max_wait seconds after the first one arrived. Each flush resolves
+    contacts with one search per 100 numbers, creates the missing ones with contacts/batch/create
+    and writes all engagements with calls/batch/create. Results are matched back per call, so
+    one rejected call fails on its own and is retried by the caller.
+    """
+
+    def __init__(self, client, contact_cache, max_batch_size=50, max_wait=0.5):
+        self.client = client
+        self.contact_cache = contact_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending = queue.Queue()
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self._thread = None
+        self._started_pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._started_pid == os.getpid():
+                return
+            self._pending = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name="hubspot-batcher", daemon=True)
+            self._thread.start()
+            self._started_pid = os.getpid()
+
+    def log_call(self, caller_id, properties, timeout=120):
+        """Queue a call engagement for the next batch and wait for it. Returns the call ID or None."""
+        self.start()
+        with self._seq_lock:
+            self._seq += 1
+            key = str(self._seq)
+        pending = _PendingCall(key, caller_id, properties)
+        self._pending.put(pending)
+        if not pending.done.wait(timeout):
+            if pending.abandon():
+                # The caller retries the call, so a later flush must not write it as well
+                logging.error(f"Timed out waiting for batched HubSpot write for {caller_id}")
+                return None
+            # Already on its way to HubSpot; giving up now would log it twice
+            pending.done.wait()
+        return pending.call_id
+
+    def _run(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._flush(batch)
+            except Exception as e:
+                logging.error(f"Batched HubSpot write of {len(batch)} calls failed: {e}")
+            finally:
+                for pending in batch:
+                    pending.done.set()
+
+    def _flush(self, batch):
+        batch = [pending for pending in batch if pending.start_writing()]
+        if not batch:
+            return
+        contacts = self._resolve_contacts({pending.caller_id for pending in batch})
+
+        ready = [pending for pending in batch if contacts.get(pending.caller_id)]
+        for pending in batch:
+            if not contacts.get(pending.caller_id):
+                logging.error(f"No contact ID available for {pending.caller_id}, cannot log call")
+        if not ready:
+            return
+
+        try:
+            created = self.client.batch_create_calls(
+                [(pending.key, contacts[pending.caller_id], pending.properties) for pending in ready]
+            )
+        except HubSpotError as e:
+            # A bad input (such as a stale cached contact) rejects the whole batch; write the
+            # calls one by one so only the bad one fails. Anything else (a 5xx, rate limiting)
+            # would fail the single writes too, so leave the whole batch to the caller's retry.
+            if e.status_code not in REJECTED_INPUT_STATUSES:
+                raise
+            logging.warning(f"Batch call create rejected, falling back to single writes: {e}")
+            created = self._create_individually(ready, contacts)
+
+        for pending in ready:
+            pending.call_id = created.get(pending.key)
+            if pending.call_id:
+                logging.info(f"Successfully logged call to HubSpot for contact {contacts[pending.caller_id]}")
+            else:
+                # The cached contact may have been merged or deleted; search again on the retry
+                self.contact_cache.invalidate(pending.caller_id)
+        logging.info(f"Logged {len(created)} of {len(batch)} batched calls to HubSpot")
+
+    def _create_individually(self, ready, contacts):
+        created = {}
+        for pending in ready:
+            try:
+                created[pending.key] = self.client.create_call(contacts[pending.caller_id], pending.properties)
+            except HubSpotError as e:
+                logging.error(str(e))
+        return created
+
+    def _resolve_contacts(self, phones):
+        contacts = {}
+        unsearched = []
+        missing = []
+        for phone in phones:
+            found, contact_id = self.contact_cache.peek(phone)
+            if contact_id:
+                contacts[phone] = contact_id
+            elif found:
+                # Searched a moment ago without a match; go straight to creating it
+                missing.append(phone)
+            else:
+                unsearched.append(phone)
+
+        if unsearched:
+            found = self.client.search_contacts_by_phones(unsearched)
+            for phone in unsearched:
+                # Numbers without a contact are cached as such, so a retry doesn't search them again
+                self.contact_cache.put(phone, found.get(phone))
+                if found.get(phone):
+                    contacts[phone] = found[phone]
+                else:
+                    missing.append(phone)
+
+        # Only create contacts we hold the creation lease for. A number another process is
+        # already creating is left unresolved rather than waited on, which would hold up every
+        # other call behind this flush; its call fails and the delivery queue retries it
+        to_create = []
+        for phone in missing:
+            if self.contact_cache.begin_create(phone):
+                to_create.append(phone)
+                continue
+            # The other process may already have created it, while we still have "no contact" cached
+            _, contact_id = self.contact_cache.refresh(phone)
+            if contact_id:
+                contacts[phone] = contact_id
+            else:
+                logging.info(f"Contact for {phone} is being created by another process, leaving its call for a retry")
+
+        if to_create:
+            created = {}
+            try:
+                created = self.client.batch_create_contacts(to_create)
+            except HubSpotError as e:
+                logging.error(str(e))
+            finally:
+                for phone in to_create:
+                    if created.get(phone):
+                        self.contact_cache.put(phone, created[phone])
+                    else:
+                        # Let the retry (here or in another process) take the lease straight away
+                        self.contact_cache.abort_create(phone)
+            contacts.update(created)
+        return contacts
@@ -0,0 +1,444 @@
+import time
+import sqlite3
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import HUBSPOT_REQUEST_SECONDS, HUBSPOT_REQUESTS, HUBSPOT_RETRIES
+
+HUBSPOT_BASE_URL = "https://api.hubapi.com"
+
+# Private apps get 100-190 requests per 10 seconds depending on tier; stay a little under the lowest.
+# This is the app's whole budget, so it only holds when every process shares one limiter.
+DEFAULT_RATE_PER_SECOND = 9
+DEFAULT_BURST = 10
+
+# The CRM search endpoints have their own, much lower, per-account limit and send no rate limit headers
+SEARCH_RATE_PER_SECOND = 4
+SEARCH_BURST = 4
+
+# Largest input list the CRM batch endpoints (and IN search filters) accept
+BATCH_LIMIT = 100
+
+# Association type for call -> contact
+CALL_TO_CONTACT_ASSOCIATION = {"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": 194}
+
+# Server errors worth another attempt. Only requests that are safe to repeat are retried
+# here: searches and PATCH updates. A create that failed with a 5xx may still have been
+# written, so it is left to the delivery queue instead of being resent straight away.
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'PATCH', 'DELETE')
+
+# Once the daily quota is used up, only probe HubSpot again after this many seconds
+DAILY_QUOTA_PROBE_SECONDS = 300
+
+
+class HubSpotError(Exception):
+    """Raised when HubSpot answers a request with an unexpected status (status_code, if any)."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class HubSpotRateLimitError(HubSpotError):
+    """Raised when HubSpot keeps answering 429 or the daily quota is used up."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket that can be paused and re-synced from server feedback."""
+
+    def __init__(self, rate_per_second, burst):
+        self.rate = float(rate_per_second)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+    def limit_remaining(self, remaining, interval_seconds):
+        # The server knows about requests from other processes sharing the app's quota; never
+        # hold more tokens than it says are left in the current window
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0:
+                self.paused_until = max(self.paused_until, time.monotonic() + interval_seconds)
+
+
+class SharedTokenBucket:
+    """Token bucket kept in a SQLite file, so every process on the host draws from one rate.
+
+    HubSpot's limits are per app, not per process: gunicorn workers and a running backfill
+    that each paced themselves separately would together send several times the rate. The
+    same interface as TokenBucket, but the state is one row per bucket name, updated in a
+    short write transaction, and measured on the wall clock the processes share.
+    """
+
+    def __init__(self, path, name, rate_per_second, burst):
+        self.path = path
+        self.name = name
+        self.rate = float(rate_per_second)
+        self.capacity = float(burst)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, paused_until REAL NOT NULL DEFAULT 0)"
+        )
+        conn.execute("INSERT OR IGNORE INTO rate_limits (name, tokens, updated) VALUES (?, ?, ?)",
+                     (name, self.capacity, time.time()))
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Losing the last few updates in a crash only hands out a little burst; skip the fsyncs
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, change):
+        # Runs change(tokens, paused_until, now) -> (tokens, paused_until, result) on the refilled
+        # state inside one write transaction and returns result
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            tokens, updated, paused_until = conn.execute(
+                "SELECT tokens, updated, paused_until FROM rate_limits WHERE name = ?", (self.name,)
+            ).fetchone()
+            now = time.time()
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            tokens, paused_until, result = change(tokens, paused_until, now)
+            conn.execute("UPDATE rate_limits SET tokens = ?, updated = ?, paused_until = ? WHERE name = ?",
+                         (tokens, now, paused_until, self.name))
+            conn.execute("COMMIT")
+            return result
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def acquire(self):
+        def take(tokens, paused_until, now):
+            if now >= paused_until and tokens >= 1:
+                return tokens - 1, paused_until, 0.0
+            return tokens, paused_until, max(paused_until - now, (1 - tokens) / self.rate)
+
+        while True:
+            wait = self._update(take)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        self._update(lambda tokens, paused_until, now: (0.0, max(paused_until, now + seconds), None))
+
+    def limit_remaining(self, remaining, interval_seconds):
+        def limit(tokens, paused_until, now):
+            if remaining <= 0:
+                paused_until = max(paused_until, now + interval_seconds)
+            return min(tokens, float(remaining)), paused_until, None
+        self._update(limit)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class HubSpotClient:
+    """Long-lived HubSpot API client: one pooled keep-alive session, paced by a token bucket.
+
+    Timeout and retry policy live here. urllib3 retries connection errors (the request never
+    reached HubSpot); 5xx responses are retried with backoff for searches and idempotent methods
+    only; 429s are handled by pausing the limiter for as long as HubSpot asks and trying again.
+    With rate_limit_db the limiters are shared with every other client using the same file.
+    """
+
+    def __init__(self, api_key, base_url=HUBSPOT_BASE_URL, timeout=10, retries=3, backoff_factor=0.5,
+                 pool_size=10, rate_per_second=DEFAULT_RATE_PER_SECOND, burst=DEFAULT_BURST,
+                 search_rate_per_second=SEARCH_RATE_PER_SECOND, max_429_retries=3, rate_limit_db=None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_429_retries = max_429_retries
+        if rate_limit_db:
+            self.limiter = SharedTokenBucket(rate_limit_db, "default", rate_per_second, burst)
+            self.search_limiter = SharedTokenBucket(rate_limit_db, "search", search_rate_per_second, SEARCH_BURST)
+        else:
+            self.limiter = TokenBucket(rate_per_second, burst)
+            self.search_limiter = TokenBucket(search_rate_per_second, SEARCH_BURST)
+        self.daily_blocked_until = 0.0
+        self.session = self._create_session(retries, backoff_factor, pool_size)
+
+    def _create_session(self, retries, backoff_factor, pool_size):
+        session = requests.Session()
+        # Connection errors only; urllib3 would not retry a POST that got a 5xx anyway, and
+        # request() decides which of those are safe to send again
+        retry = Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=backoff_factor,
+                      respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Authorization': f'Bearer {self.api_key}', 'Content-Type': 'application/json'})
+        return session
+
+    def request(self, method, path, operation="other", **kwargs):
+        """Send a request, pacing it and retrying 429s. operation names it in the metrics.
+
+        5xx responses are retried for searches and idempotent methods; for anything else the
+        5xx response is returned to the caller.
+        """
+        if time.monotonic() < self.daily_blocked_until:
+            raise HubSpotRateLimitError("HubSpot daily API quota exhausted")
+
+        is_search = path.rstrip('/').endswith('/search')
+        retry_server_errors = is_search or method.upper() in IDEMPOTENT_METHODS
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault('timeout', self.timeout)
+
+        rate_limited = server_errors = 0
+        while True:
+            self.limiter.acquire()
+            if is_search:
+                self.search_limiter.acquire()
+            response = self._send(method, url, operation, **kwargs)
+            self._observe(response, is_search)
+
+            if response.status_code == 429:
+                rate_limited += 1
+                if rate_limited > self.max_429_retries:
+                    raise HubSpotRateLimitError(f"HubSpot kept rate limiting {method} {path}")
+                HUBSPOT_RETRIES.inc(operation=operation, reason="rate_limited")
+                logging.warning(f"HubSpot rate limited {method} {path} (attempt {rate_limited})")
+                continue
+
+            if (response.status_code in SERVER_ERROR_STATUSES and retry_server_errors
+                    and server_errors < self.retries):
+                server_errors += 1
+                HUBSPOT_RETRIES.inc(operation=operation, reason="server_error")
+                logging.warning(f"HubSpot answered {method} {path} with {response.status_code} "
+                                f"(attempt {server_errors})")
+                time.sleep(self.backoff_factor * 2 ** (server_errors - 1))
+                continue
+
+            return response
+
+    def _send(self, method, url, operation, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            HUBSPOT_REQUESTS.inc(operation=operation, status="error")
+            raise
+        finally:
+            HUBSPOT_REQUEST_SECONDS.observe(time.perf_counter() - started, operation=operation)
+        HUBSPOT_REQUESTS.inc(operation=operation, status=str(response.status_code))
+        # Connection errors urllib3 already retried inside this call
+        retries = getattr(getattr(response.raw, 'retries', None), 'history', ())
+        if retries:
+            HUBSPOT_RETRIES.inc(len(retries), operation=operation, reason="connection_error")
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+    def create_call(self, contact_id, properties):
+        """Create a call engagement associated with the contact and return its ID."""
+        payload = {
+            "properties": properties,
+            "associations": [{"to": {"id": contact_id}, "types": [CALL_TO_CONTACT_ASSOCIATION]}]
+        }
+        response = self.post("/crm/v3/objects/calls", json=payload, operation="create_call")
+        if response.status_code != 201:
+            raise HubSpotError(f"Failed to log call: {response.status_code} - {response.text}", response.status_code)
+        return response.json().get('id')
+
+    def update_call(self, call_id, properties):
+        response = self.patch(f"/crm/v3/objects/calls/{call_id}", json={"properties": properties}, operation="update_call")
+        if response.status_code != 200:
+            raise HubSpotError(f"Failed to update call {call_id}: {response.status_code} - {response.text}", response.status_code)
+
+    def search_contacts_by_phones(self, phones):
+        """Look up many numbers with one search per 100 numbers.
+
+        Returns {phone: contact_id} for the numbers that matched a contact's phone or mobile phone;
+        numbers without a contact are absent.
+        """
+        found = {}
+        phones = list(phones)
+        for start in range(0, len(phones), BATCH_LIMIT):
+            chunk = phones[start:start + BATCH_LIMIT]
+            payload = {
+                "filterGroups": [
+                    {"filters": [{"propertyName": "phone", "operator": "IN", "values": chunk}]},
+                    {"filters": [{"propertyName": "mobilephone", "operator": "IN", "values": chunk}]}
+                ],
+                "properties": ["phone", "mobilephone"],
+                "limit": BATCH_LIMIT
+            }
+            wanted = set(chunk)
+            while True:
+                response = self.post("/crm/v3/objects/contacts/search", json=payload, operation="batch_search_contacts")
+                if response.status_code != 200:
+                    raise HubSpotError(f"Contact search failed: {response.status_code} - {response.text}", response.status_code)
+                body = response.json()
+                for result in body.get('results', []):
+                    properties = result.get('properties') or {}
+                    for prop in ("phone", "mobilephone"):
+                        phone = properties.get(prop)
+                        if phone in wanted and phone not in found:
+                            found[phone] = result.get('id')
+                after = (body.get('paging') or {}).get('next', {}).get('after')
+                if not after:
+                    break
+                payload["after"] = after
+        return found
+
+    def batch_create_contacts(self, phones):
+        """Create an Unknown Caller contact per number. Returns {phone: contact_id} for those created."""
+        created = {}
+        phones = list(phones)
+        for start in range(0, len(phones), BATCH_LIMIT):
+            chunk = phones[start:start + BATCH_LIMIT]
+            payload = {"inputs": [
+                {"properties": {"phone": phone, "firstname": "Unknown", "lastname": "Caller"}} for phone in chunk
+            ]}
+            response = self.post("/crm/v3/objects/contacts/batch/create", json=payload, operation="batch_create_contacts")
+            if response.status_code not in (200, 201, 207):
+                raise HubSpotError(f"Failed to create contacts: {response.status_code} - {response.text}", response.status_code)
+            matched = 0
+            for result in response.json().get('results', []):
+                phone = (result.get('properties') or {}).get('phone')
+                if phone in chunk:
+                    created[phone] = result.get('id')
+                    matched += 1
+            if matched < len(chunk):
+                logging.error(f"Batch contact create partially failed: {response.json().get('errors')}")
+        logging.info(f"Created {len(created)} new contacts")
+        return created
+
+    def batch_create_calls(self, calls):
+        """Create call engagements in bulk.
+
+        calls is a list of (key, contact_id, properties) with unique string keys. Returns
+        {key: call_id} for the calls HubSpot created; missing keys failed and can be retried.
+        If a later chunk fails, the calls created by the earlier ones are still returned.
+        """
+        created = {}
+        for start in range(0, len(calls), BATCH_LIMIT):
+            chunk = calls[start:start + BATCH_LIMIT]
+            try:
+                created.update(self._batch_create_call_chunk(chunk))
+            except (HubSpotError, requests.RequestException) as e:
+                if not created:
+                    raise
+                # The earlier chunks are written; report them so only the rest is retried
+                logging.error(f"Batch call create stopped after {len(created)} of {len(calls)} calls: {e}")
+                break
+        return created
+
+    def _batch_create_call_chunk(self, chunk):
+        payload = {"inputs": [
+            {
+                "properties": properties,
+                "associations": [{"to": {"id": contact_id}, "types": [CALL_TO_CONTACT_ASSOCIATION]}],
+                "objectWriteTraceId": key
+            }
+            for key, contact_id, properties in chunk
+        ]}
+        response = self.post("/crm/v3/objects/calls/batch/create", json=payload, operation="batch_create_calls")
+        if response.status_code not in (200, 201, 207):
+            raise HubSpotError(f"Failed to log calls: {response.status_code} - {response.text}", response.status_code)
+
+        # Results are not returned in input order; match them on the trace ID, or on the
+        # caller's number when the trace ID is not echoed back and the number is unique in the chunk
+        numbers = {key: properties.get("hs_call_from_number") for key, _, properties in chunk}
+        by_number = {}
+        for key, number in numbers.items():
+            by_number[number] = None if number in by_number else key
+        created = {}
+        unmatched = []
+        for result in response.json().get('results', []):
+            key = result.get('objectWriteTraceId')
+            if key not in numbers:
+                key = by_number.get((result.get('properties') or {}).get("hs_call_from_number"))
+            if key is not None and key not in created:
+                created[key] = result.get('id')
+            else:
+                unmatched.append(result)
+
+        # Every result is a call HubSpot has written, so resending any of them would log it twice.
+        # Hand each unmatched one to a remaining input from the same number, or to any remaining
+        # input when HubSpot reported no failures; which of a caller's calls gets which ID only
+        # matters for late updates.
+        for result in unmatched:
+            number = (result.get('properties') or {}).get("hs_call_from_number")
+            remaining = [key for key in numbers if key not in created]
+            key = next((key for key in remaining if numbers[key] == number), None)
+            if key is None and response.status_code != 207 and remaining:
+                key = remaining[0]
+            if key is None:
+                logging.error(f"Could not match batch call create result {result.get('id')} to a call")
+                continue
+            logging.warning(f"Matched batch call create result {result.get('id')} to call {key} without its trace ID")
+            created[key] = result.get('id')
+
+        if response.status_code == 207:
+            logging.error(f"Batch call create partially failed: {response.json().get('errors')}")
+        return created
+
+    def _observe(self, response, is_search):
+        headers = response.headers
+
+        daily_remaining = headers.get('X-HubSpot-RateLimit-Daily-Remaining')
+        if daily_remaining is not None and daily_remaining.isdigit() and int(daily_remaining) <= 0:
+            self.daily_blocked_until = time.monotonic() + DAILY_QUOTA_PROBE_SECONDS
+
+        remaining = headers.get('X-HubSpot-RateLimit-Remaining')
+        interval_ms = headers.get('X-HubSpot-RateLimit-Interval-Milliseconds')
+        if remaining is not None and remaining.isdigit():
+            interval = int(interval_ms) / 1000 if interval_ms and interval_ms.isdigit() else 10.0
+            self.limiter.limit_remaining(int(remaining), interval)
+
+        if response.status_code == 429:
+            retry_after = headers.get('Retry-After')
+            try:
+                delay = float(retry_after) if retry_after else 1.0
+            except ValueError:
+                delay = 1.0
+            (self.search_limiter if is_search else self.limiter).pause(delay)
+
@@ -0,0 +1,417 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process development only
+    fcntl = None
+
+# Latency buckets in seconds, from a cached TwiML response up to a slow HubSpot batch
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Each process publishes its numbers to <directory>/metrics.<pid>.json this often, so whichever
+# gunicorn worker serves a scrape can report the total across all of them
+SNAPSHOT_PREFIX = "metrics."
+SNAPSHOT_SUFFIX = ".json"
+SNAPSHOT_INTERVAL = 5.0
+# Counters and histograms of processes that have exited, folded into one file so scrapes don't
+# read a file per recycled worker; the lock file serializes the folding
+EXITED_SNAPSHOT = f"{SNAPSHOT_PREFIX}exited{SNAPSHOT_SUFFIX}"
+SNAPSHOT_LOCK = f"{SNAPSHOT_PREFIX}lock"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _clear(self):
+        with self._lock:
+            self._values = {}
+
+    def _merge(self, current, value):
+        # Combine one process's value into the total across processes
+        return value if current is None else current + value
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in (self._snapshot() if values is None else sorted(values.items())):
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Mirror a count kept elsewhere, such as ContactCache.stats()."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self, key, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', _format_value(float(bound)))])} {cumulative}")
+        lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format_value(total)}")
+        lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+
+    def _merge(self, current, value):
+        counts, total = value
+        if current is None:
+            return [list(counts), total]
+        return [[a + b for a, b in zip(current[0], counts)], current[1] + total]
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _snapshot_pid(name):
+    if not name.startswith(SNAPSHOT_PREFIX) or not name.endswith(SNAPSHOT_SUFFIX):
+        return None
+    try:
+        return int(name[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)])
+    except ValueError:
+        return None
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return None
+
+
+def _write_snapshot(path, snapshot):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+
+def remove_snapshots(directory):
+    """Delete the published snapshots of a previous run; call before any worker starts."""
+    if not directory or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and (name.endswith(SNAPSHOT_SUFFIX) or name.endswith(".tmp")):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+class Registry:
+    """Metrics in the Prometheus text exposition format.
+
+    On its own a registry reports the process it lives in. After share(directory), every
+    process started with start() publishes a snapshot to that directory every few seconds and
+    render() reports the sum over all of them: counters and histograms include processes that
+    have exited, gauges only live ones. The snapshots of exited processes are folded into a
+    single file, so a scrape reads one file per live process plus one.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._collectors = []
+        self.directory = None
+        self.interval = SNAPSHOT_INTERVAL
+        self._values_pid = os.getpid()
+        self._writer_pid = None
+        self._publish_lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collect):
+        """Call collect() before every render and snapshot, to copy in numbers kept elsewhere."""
+        with self._lock:
+            if collect not in self._collectors:
+                self._collectors.append(collect)
+
+    def share(self, directory, interval=SNAPSHOT_INTERVAL):
+        """Aggregate across the processes that publish to directory. Opens nothing until start()."""
+        self.directory = directory
+        self.interval = interval
+
+    def start(self):
+        """Start publishing this process's snapshots. Only the first call in each process does any work."""
+        if not self.directory or self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            if self._values_pid != os.getpid():
+                # Numbers copied from the parent across a fork are the parent's, not ours
+                for metric in self._metrics.values():
+                    metric._clear()
+                self._values_pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            # A snapshot under our PID is an exited process's that we would overwrite
+            self._fold_exited(self._metrics.values(), own=True)
+            threading.Thread(target=self._publish_periodically, name="metrics-snapshot", daemon=True).start()
+            atexit.register(self._publish_at_exit)
+            self._writer_pid = os.getpid()
+
+    def _collect(self):
+        with self._lock:
+            collectors = list(self._collectors)
+        for collect in collectors:
+            try:
+                collect()
+            except Exception as e:
+                logging.error(f"Collecting metrics failed: {e}")
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.directory, f"{SNAPSHOT_PREFIX}{pid}{SNAPSHOT_SUFFIX}")
+
+    def _publish(self):
+        if self._writer_pid != os.getpid():
+            return
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {metric.name: [[list(key), value] for key, value in metric._snapshot()] for metric in metrics}
+        with self._publish_lock:
+            _write_snapshot(self._snapshot_path(os.getpid()), snapshot)
+
+    def _publish_at_exit(self):
+        # Best effort: the directory may already be gone when the process shuts down
+        try:
+            self._collect()
+            self._publish()
+        except OSError:
+            pass
+
+    def _publish_periodically(self):
+        pid = os.getpid()
+        while True:
+            time.sleep(self.interval)
+            if self._writer_pid != pid:
+                return
+            try:
+                self._collect()
+                self._publish()
+            except Exception as e:
+                logging.error(f"Publishing metrics snapshot failed: {e}")
+
+    @contextmanager
+    def _directory_lock(self):
+        with open(os.path.join(self.directory, SNAPSHOT_LOCK), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def _fold_exited(self, metrics, own=False):
+        """Add the counters and histograms of exited processes to the exited snapshot and delete their files."""
+        by_name = {metric.name: metric for metric in metrics}
+        with self._directory_lock():
+            exited_path = os.path.join(self.directory, EXITED_SNAPSHOT)
+            exited = {}
+            for metric_name, samples in (_read_snapshot(exited_path) or {}).items():
+                exited[metric_name] = {tuple(key): value for key, value in samples}
+            folded = []
+            for name in os.listdir(self.directory):
+                pid = _snapshot_pid(name)
+                if pid is None or (_process_alive(pid) and not (own and pid == os.getpid())):
+                    continue
+                path = os.path.join(self.directory, name)
+                for metric_name, samples in (_read_snapshot(path) or {}).items():
+                    metric = by_name.get(metric_name)
+                    if metric is None or metric.kind == "gauge":
+                        continue
+                    values = exited.setdefault(metric_name, {})
+                    for key, value in samples:
+                        key = tuple(key)
+                        values[key] = metric._merge(values.get(key), value)
+                folded.append(path)
+            if not folded:
+                return
+            _write_snapshot(exited_path, {metric_name: [[list(key), value] for key, value in values.items()]
+                                          for metric_name, values in exited.items()})
+            for path in folded:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _merged(self, metrics):
+        self._fold_exited(metrics)
+        totals = {metric.name: {} for metric in metrics}
+        by_name = {metric.name: metric for metric in metrics}
+        for name in os.listdir(self.directory):
+            if name != EXITED_SNAPSHOT and _snapshot_pid(name) is None:
+                continue
+            snapshot = _read_snapshot(os.path.join(self.directory, name))
+            if snapshot is None:
+                continue
+            for metric_name, samples in snapshot.items():
+                metric = by_name.get(metric_name)
+                if metric is None:
+                    continue
+                values = totals[metric_name]
+                for key, value in samples:
+                    key = tuple(key)
+                    values[key] = metric._merge(values.get(key), value)
+        return totals
+
+    def render(self):
+        self._collect()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        totals = None
+        if self.directory and self._writer_pid == os.getpid():
+            self._publish()
+            totals = self._merged(metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(totals[metric.name] if totals is not None else None))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Shared by the modules that record them; kept here so every name is defined in one place
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "Webhook latency by route.", ["route", "method"])
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "Webhook requests by route and response status.", ["route", "status"])
+HUBSPOT_REQUEST_SECONDS = REGISTRY.histogram(
+    "hubspot_request_duration_seconds", "HubSpot API latency by operation, per attempt.", ["operation"])
+HUBSPOT_REQUESTS = REGISTRY.counter(
+    "hubspot_requests_total", "HubSpot API responses by operation and HTTP status (\"error\" if none).",
+    ["operation", "status"])
+HUBSPOT_RETRIES = REGISTRY.counter(
+    "hubspot_retries_total", "HubSpot API retries by operation and reason.", ["operation", "reason"])
+STORE_WRITE_SECONDS = REGISTRY.histogram(
+    "store_write_duration_seconds", "Time to durably record state, by store.", ["store"])
+DEDUPE_CLAIMS = REGISTRY.counter(
+    "dedupe_claims_total", "Calls claimed for logging, by result (\"duplicate\" was already processed).", ["result"])
+CALL_QUEUE_RETRIES = REGISTRY.counter(
+    "call_queue_retries_total", "Call event deliveries scheduled for another attempt.")
+CALL_QUEUE_DEAD_LETTERS = REGISTRY.counter(
+    "call_queue_dead_letters_total", "Call events moved to the dead-letter file.")
+CALL_QUEUE_DEPTH = REGISTRY.gauge(
+    "call_queue_depth", "Call events waiting for delivery or being delivered.")
+CONTACT_CACHE_LOOKUPS = REGISTRY.counter(
+    "contact_cache_lookups_total", "Contact cache lookups by result.", ["result"])
+DEDUPE_SWEEPS = REGISTRY.counter(
+    "dedupe_sweeps_total", "Retention sweeps of processed calls.")
+DEDUPE_EVICTED = REGISTRY.counter(
+    "dedupe_evicted_total", "Processed call records removed by retention sweeps.")
+DEDUPE_SWEEP_SECONDS = REGISTRY.counter(
+    "dedupe_sweep_duration_seconds_total", "Time spent in retention sweeps.")
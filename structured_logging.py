@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# LogRecord attributes that are not extra fields passed with extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and any extra={...} fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic "time - level - message" line, followed by any extra={...} fields as JSON."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - %(message)s')
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        extra = {key: value for key, value in vars(record).items()
+                 if key not in _RECORD_ATTRIBUTES and not key.startswith('_')}
+        return f"{line} {json.dumps(extra, default=str)}" if extra else line
+
+
+class ForkSafeQueueHandler(QueueHandler):
+    """Hands records to a background thread that formats and writes them.
+
+    Logging on a request thread is then only a queue put. The writer thread is started on the
+    first record in each process, so importing the app starts no threads and a forked gunicorn
+    worker gets its own writer instead of a dead copy of the master's.
+    """
+
+    def __init__(self, handlers):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self._listener = None
+        self._listener_pid = None
+        self._stopped = False
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self.queue = queue.SimpleQueue()
+            self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+            self._listener_pid = os.getpid()
+
+    def prepare(self, record):
+        # Resolve the message and traceback here, where the arguments and exception are still
+        # current, but keep extra fields as attributes for the formatter
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if self._stopped:
+            # Shutting down: no new writer thread, write directly
+            for handler in self.handlers:
+                handler.handle(self.prepare(record))
+            return
+        self._ensure_listener()
+        super().emit(record)
+
+    def stop(self):
+        """Stop the writer thread after it has written everything queued so far."""
+        with self._start_lock:
+            self._stopped = True
+            if self._listener is not None and self._listener_pid == os.getpid():
+                self._listener.stop()
+            self._listener_pid = None
+
+
+def configure(level="INFO", fmt="json"):
+    """Route the root logger through a ForkSafeQueueHandler writing to stderr. Safe to call again."""
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers:
+        if isinstance(handler, ForkSafeQueueHandler):
+            return handler
+
+    stream = logging.StreamHandler(sys.stderr)
+    if fmt == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(TextFormatter())
+    handler = ForkSafeQueueHandler([stream])
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    atexit.register(handler.stop)
+    return handler
+
+
+def log_payload(message, payload, sample_rate):
+    """Log a webhook payload for a sample_rate fraction of requests (everything at DEBUG level)."""
+    if random.random() < sample_rate or logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.info(message, extra={'payload': dict(payload)})
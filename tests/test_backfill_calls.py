@@ -0,0 +1,117 @@
+import json
+import time
+from collections import Counter
+
+from backfill_calls import Backfill, BackfillCall, Checkpoint, group_calls
+from dedupe_store import MemoryDedupeStore
+
+
+def call_with(parent=None, legs=()):
+    call = BackfillCall("CA1")
+    call.parent = parent
+    call.legs = list(legs)
+    return call
+
+
+def test_completed_leg_longer_than_the_minimum_is_connected():
+    call = call_with({'sid': "CA1", 'status': "completed", 'duration': "90"}, [
+        {'sid': "CL1", 'status': "canceled", 'duration': "0"},
+        {'sid': "CL2", 'status': "completed", 'duration': "75"},
+    ])
+    assert call.classify() == ("CONNECTED", "COMPLETED", 75)
+
+
+def test_short_or_unanswered_legs_are_missed():
+    assert call_with(legs=[{'sid': "CL1", 'status': "completed", 'duration': "10"}]).classify() == \
+        ("NO_ANSWER", "MISSED", 10)
+    assert call_with(legs=[{'sid': "CL1", 'status': "no-answer", 'duration': "0"}]).classify() == \
+        ("NO_ANSWER", "MISSED", 0)
+
+
+def test_parent_without_legs_is_not_answered():
+    # The parent call is "completed" whenever the TwiML ran, even if no technician picked up
+    call = call_with({'sid': "CA1", 'status': "completed", 'duration': "32"})
+    assert call.classify() == ("NO_ANSWER", "MISSED", 0)
+
+
+def test_group_calls_collects_legs_under_their_parent():
+    stats = Counter()
+    records = [
+        {'sid': "CA1", 'direction': "inbound", 'from': "+15550100"},
+        {'sid': "CL1", 'parent_call_sid': "CA1", 'status': "completed"},
+        {'sid': "CA2", 'direction': "inbound", 'from': "+15550101"},
+        {'sid': "CA3", 'direction': "outbound-api"},
+        {'sid': "CL2", 'parent_call_sid': "CA1", 'status': "canceled"},
+        {'from': "+15550102"},
+    ]
+    calls = list(group_calls(records, window=10, stats=stats))
+    assert [call.root_sid for call in calls] == ["CA1", "CA2"]
+    assert calls[0].sids == ["CL1", "CL2"]
+    assert calls[0].phone == "+15550100"
+    assert stats['rows'] == 6
+    assert stats['rows_not_inbound'] == 1
+    assert stats['rows_invalid'] == 1
+
+
+def test_group_calls_drops_legs_that_arrive_after_their_call_left_the_window():
+    stats = Counter()
+    records = [
+        {'sid': "CA1", 'direction': "inbound"},
+        {'sid': "CA2", 'direction': "inbound"},
+        {'sid': "CL1", 'parent_call_sid': "CA1"},
+    ]
+    calls = list(group_calls(records, window=1, stats=stats))
+    assert [call.root_sid for call in calls] == ["CA1", "CA2"]
+    assert calls[0].legs == []
+    assert stats['late_legs'] == 1
+
+
+class StubConnector:
+    def __init__(self):
+        self.dedupe_store = MemoryDedupeStore()
+        self.logged = []
+
+    def log_call_to_hubspot(self, caller_id, call_duration, call_timestamp, disposition, status, call_sid):
+        self.logged.append(call_sid)
+        return f"call-{call_sid}"
+
+
+def export(count):
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    return [{'sid': f"CA{i}", 'direction': "inbound", 'from': "+15550100", 'start_time': now} for i in range(count)]
+
+
+def run_backfill(connector, records, checkpoint_path):
+    backfill = Backfill(connector)
+    checkpoint = Checkpoint(str(checkpoint_path), "calls.jsonl", 10)
+    return backfill.run(group_calls(records, 10, backfill.stats), checkpoint, workers=2)
+
+
+def test_rerun_resumes_after_the_checkpoint(tmp_path):
+    connector = StubConnector()
+    run_backfill(connector, export(5), tmp_path / "calls.checkpoint.json")
+    assert sorted(connector.logged) == [f"CA{i}" for i in range(5)]
+
+    connector.logged = []
+    stats = run_backfill(connector, export(7), tmp_path / "calls.checkpoint.json")
+    assert stats['resumed'] == 5
+    assert sorted(connector.logged) == ["CA5", "CA6"]
+
+
+def test_calls_in_flight_at_a_kill_are_logged_by_the_rerun(tmp_path):
+    connector = StubConnector()
+    checkpoint_path = tmp_path / "calls.checkpoint.json"
+    # A run killed after claiming CA1 and CA2 but before writing them
+    checkpoint = Checkpoint(str(checkpoint_path), "calls.jsonl", 10)
+    checkpoint.calls_done = 1
+    checkpoint.claimed("CA1", {})
+    checkpoint.claimed("CA2", {})
+    connector.dedupe_store.claim("+15550100", "CA1")
+    connector.dedupe_store.claim("+15550100", "CA2")
+    assert json.loads(checkpoint_path.read_text())['in_flight'] == ["CA1", "CA2"]
+
+    stats = run_backfill(connector, export(3), checkpoint_path)
+    assert stats['resumed'] == 1
+    assert stats['already_logged'] == 0
+    assert sorted(connector.logged) == ["CA1", "CA2"]
+    assert json.loads(checkpoint_path.read_text())['in_flight'] == []
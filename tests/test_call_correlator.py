@@ -0,0 +1,134 @@
+import threading
+import time
+
+from call_correlator import CallCorrelator, EMIT_LEASE_SECONDS
+
+
+def test_memory_correlator_handles_concurrent_writers():
+    correlator = CallCorrelator(":memory:", emit=lambda call: None, update=lambda call: None)
+    errors = []
+
+    def record(thread):
+        try:
+            for i in range(200):
+                correlator.record_leg(f"CA{thread}-{i}", f"CL{thread}-{i}", "+15550100", "completed", 30)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            correlator.close()
+
+    threads = [threading.Thread(target=record, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert correlator.flush_due(now=float("inf")) == 1600
+
+
+def test_late_connected_leg_updates_emitted_call(tmp_path):
+    emitted, updated = [], []
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=emitted.append, update=updated.append)
+
+    correlator.record_dial("CA1", "+15550100", "no-answer", dial_call_sid="CL1")
+    assert correlator.flush_due(now=float("inf")) == 1
+    assert emitted[0].classify()[0] == "NO_ANSWER"
+
+    correlator.record_leg("CA1", "CL2", "+15550100", "completed", 45)
+    assert [call.root_sid for call in updated] == ["CA1"]
+    assert updated[0].classify() == ("CONNECTED", "COMPLETED", 45)
+
+
+def test_skipped_call_gets_no_late_updates(tmp_path):
+    emitted, updated = [], []
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=emitted.append, update=updated.append)
+
+    correlator.record_dial("CA1", "+15550100", "no-answer", dial_call_sid="CL1")
+    correlator.flush_due(now=float("inf"))
+    correlator.skip("CA1")
+    assert correlator.is_skipped("CA1")
+
+    correlator.record_leg("CA1", "CL2", "+15550100", "completed", 45)
+    assert updated == []
+    assert correlator.expire(cutoff_timestamp=float("inf")) == 1
+
+
+def test_skip_keeps_a_call_that_has_an_engagement(tmp_path):
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=lambda call: None, update=lambda call: None)
+    correlator.record_dial("CA1", "+15550100", "completed", dial_call_sid="CL1")
+    correlator.flush_due(now=float("inf"))
+    correlator.set_engagement("CA1", "42")
+    correlator.skip("CA1")
+    assert not correlator.is_skipped("CA1")
+
+
+def test_canceled_sibling_leg_does_not_settle_a_long_call(tmp_path):
+    emitted, updated = [], []
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=emitted.append, update=updated.append)
+    start = time.time()
+
+    # Simultaneous ring: the other technician's leg is canceled as soon as one answers
+    correlator.record_leg("CA1", "CL1", "+15550100", "canceled")
+    assert correlator.flush_due(now=start + 61) == 0
+
+    # Ten minutes later the answered leg and the dial result report
+    correlator.record_leg("CA1", "CL2", "+15550100", "completed", 590)
+    correlator.record_dial("CA1", "+15550100", "completed", dial_call_sid="CL2", dial_duration=590)
+    assert correlator.flush_due(now=time.time() + correlator.settle) == 1
+    assert emitted[0].classify() == ("CONNECTED", "COMPLETED", 590)
+    assert updated == []
+
+
+def test_unanswered_legs_fall_back_to_the_window(tmp_path):
+    emitted = []
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=emitted.append, update=lambda call: None)
+    start = time.time()
+
+    correlator.record_leg("CA1", "CL1", "+15550100", "no-answer")
+    assert correlator.flush_due(now=start + correlator.settle + 1) == 0
+    assert correlator.flush_due(now=start + correlator.window + 1) == 1
+    assert emitted[0].classify() == ("NO_ANSWER", "MISSED", 0)
+
+
+def test_call_is_emitted_again_if_the_emitter_dies(tmp_path):
+    emitted = []
+
+    def die(call):
+        raise SystemExit("worker killed")
+
+    dying = CallCorrelator(str(tmp_path / "calls.db"), emit=die, update=lambda call: None)
+    dying.record_dial("CA1", "+15550100", "completed", dial_call_sid="CL1", dial_duration=40)
+    now = time.time() + dying.settle
+    try:
+        dying.flush_due(now=now)
+    except SystemExit:
+        pass
+
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=emitted.append, update=lambda call: None)
+    assert correlator.flush_due(now=now + 1) == 0
+    assert correlator.flush_due(now=now + EMIT_LEASE_SECONDS + 1) == 1
+    assert emitted[0].recovered
+    assert correlator.flush_due(now=float("inf")) == 0
+
+
+def test_leg_reported_while_emitting_is_sent_as_an_update(tmp_path):
+    updated = []
+
+    def emit(call):
+        correlator.record_leg("CA1", "CL2", "+15550100", "completed", 45)
+
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=emit, update=updated.append)
+    correlator.record_dial("CA1", "+15550100", "no-answer", dial_call_sid="CL1")
+    assert correlator.flush_due(now=float("inf")) == 1
+    assert [call.classify() for call in updated] == [("CONNECTED", "COMPLETED", 45)]
+
+
+def test_canceled_leg_does_not_override_a_completed_dial(tmp_path):
+    emitted = []
+    correlator = CallCorrelator(str(tmp_path / "calls.db"), emit=emitted.append, update=lambda call: None)
+
+    correlator.record_leg("CA1", "CL2", "+15550100", "canceled", 0)
+    correlator.record_dial("CA1", "+15550100", "completed", dial_call_sid="CL1", dial_duration=120)
+    assert correlator.flush_due(now=float("inf")) == 1
+    assert emitted[0].classify() == ("CONNECTED", "COMPLETED", 120)
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import threading
+import multiprocessing
+
+import pytest
+
+import call_queue
+from call_queue import CallEventQueue, JOURNAL_PREFIX, JOURNAL_SUFFIX
+
+
+def write_journal(path, records):
+    with open(path, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def journal_path(journal_dir, pid):
+    return os.path.join(journal_dir, f"{JOURNAL_PREFIX}{pid}{JOURNAL_SUFFIX}")
+
+
+class Recorder:
+    def __init__(self, expected):
+        self.events = []
+        self.expected = expected
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) >= self.expected:
+                self.done.set()
+        return True
+
+
+def put(event_id, event):
+    return {'op': 'put', 'id': event_id, 'event': event, 'attempts': 0}
+
+
+def test_recovers_unacknowledged_events_from_orphaned_journal(tmp_path):
+    orphan = journal_path(str(tmp_path), 999999)
+    write_journal(orphan, [put('a', {'n': 1}), put('b', {'n': 2}), {'op': 'ack', 'id': 'a'}])
+    with open(orphan, 'a') as f:
+        f.write('{"op": "put", "id": "torn')
+
+    deliver = Recorder(expected=1)
+    queue = CallEventQueue(deliver, journal_dir=str(tmp_path), workers=1, fsync=False)
+    queue.start()
+    try:
+        assert deliver.done.wait(5)
+        assert deliver.events == [{'n': 2}]
+        assert not os.path.exists(orphan)
+    finally:
+        queue.stop()
+
+
+def test_recovers_journal_left_by_dead_process_with_same_pid(tmp_path):
+    own = journal_path(str(tmp_path), os.getpid())
+    write_journal(own, [put('a', {'n': 1})])
+
+    deliver = Recorder(expected=1)
+    queue = CallEventQueue(deliver, journal_dir=str(tmp_path), workers=1, fsync=False)
+    queue.start()
+    try:
+        assert deliver.done.wait(5)
+        assert deliver.events == [{'n': 1}]
+        assert os.path.exists(own)
+    finally:
+        queue.stop()
+
+
+def test_pending_events_survive_restart(tmp_path):
+    queue = CallEventQueue(lambda event: False, journal_dir=str(tmp_path), workers=0, fsync=False)
+    queue.enqueue({'n': 1})
+    queue.stop()
+
+    deliver = Recorder(expected=1)
+    queue = CallEventQueue(deliver, journal_dir=str(tmp_path), workers=1, fsync=False)
+    queue.start()
+    try:
+        assert deliver.done.wait(5)
+        assert deliver.events == [{'n': 1}]
+    finally:
+        queue.stop()
+
+
+@pytest.mark.skipif(call_queue.fcntl is None, reason="journal locking needs fcntl")
+def test_does_not_adopt_journal_of_live_process(tmp_path):
+    live = journal_path(str(tmp_path), 999999)
+    write_journal(live, [put('a', {'n': 1})])
+    with open(live, 'r+') as owner:
+        call_queue._lock_file(owner)
+
+        queue = CallEventQueue(lambda event: True, journal_dir=str(tmp_path), workers=1, fsync=False)
+        queue.start()
+        try:
+            assert queue.depth() == 0
+            assert os.path.exists(live)
+        finally:
+            queue.stop()
+
+
+def _start_queue_and_report(journal_dir, barrier, results):
+    queue = CallEventQueue(lambda event: True, journal_dir=journal_dir, workers=1, fsync=False)
+    barrier.wait()
+    queue.start()
+    # Let every sibling finish its adoption pass before checking our journal is still there
+    barrier.wait()
+    path = queue._journal_path
+    results.put(os.path.exists(path) and os.stat(path).st_ino == os.fstat(queue._journal.fileno()).st_ino)
+    queue.stop()
+
+
+@pytest.mark.skipif(call_queue.fcntl is None, reason="journal locking needs fcntl")
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_starts_never_adopt_each_others_journals(tmp_path):
+    context = multiprocessing.get_context("fork")
+    processes = 8
+    for round_number in range(40):
+        journal_dir = str(tmp_path / str(round_number))
+        barrier = context.Barrier(processes)
+        results = context.Queue()
+        workers = [context.Process(target=_start_queue_and_report, args=(journal_dir, barrier, results))
+                   for _ in range(processes)]
+        for worker in workers:
+            worker.start()
+        outcomes = [results.get(timeout=30) for _ in workers]
+        for worker in workers:
+            worker.join(30)
+        assert outcomes == [True] * processes
+
+
+def test_dead_lettered_events_are_reported(tmp_path):
+    dead = []
+    queue = CallEventQueue(lambda event: False, journal_dir=str(tmp_path), workers=1, max_attempts=1,
+                           fsync=False, on_dead_letter=dead.append)
+    queue.enqueue({'n': 1})
+    try:
+        deadline = time.monotonic() + 5
+        while not dead and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert dead == [{'n': 1}]
+        with open(queue.dead_letter_path) as f:
+            assert json.loads(f.readline())['event'] == {'n': 1}
+    finally:
+        queue.stop()
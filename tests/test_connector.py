@@ -0,0 +1,44 @@
+import os
+import threading
+import multiprocessing
+
+import pytest
+
+from TwilioHubspotConnector import create_app
+
+
+def app_in(tmp_path):
+    return create_app({
+        'DEDUPE_DB': str(tmp_path / "processed_calls.db"),
+        'CONTACT_CACHE_DB': str(tmp_path / "contact_cache.db"),
+        'CALL_QUEUE_DIR': str(tmp_path / "call_queue"),
+        'HUBSPOT_RATE_LIMIT_DB': str(tmp_path / "hubspot_rate_limit.db"),
+        'METRICS_DIR': str(tmp_path / "metrics"),
+        'ROUTING_FILE': "",
+    })
+
+
+def test_create_app_opens_nothing_and_starts_no_threads(tmp_path):
+    threads = set(threading.enumerate())
+    app = app_in(tmp_path)
+    assert app.extensions['connector']._services == {}
+    assert set(threading.enumerate()) - threads == set()
+    assert os.listdir(tmp_path) == []
+
+
+def _service_is_inherited(connector, service, conn):
+    conn.send(connector._service('example', object) is service)
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_services_are_rebuilt_in_a_forked_child(tmp_path):
+    connector = app_in(tmp_path).extensions['connector']
+    service = connector._service('example', object)
+    assert connector._service('example', object) is service
+
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe()
+    child = context.Process(target=_service_is_inherited, args=(connector, service, child_conn))
+    child.start()
+    assert parent_conn.recv() is False
+    child.join(10)
@@ -0,0 +1,66 @@
+import time
+
+from contact_cache import ContactCache, SqliteContactStore
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ContactCache(max_size=2)
+    cache.put("+15550100", "1")
+    cache.put("+15550101", "2")
+    assert cache.peek("+15550100") == (True, "1")
+    cache.put("+15550102", "3")
+    assert cache.peek("+15550101") == (False, None)
+    assert cache.peek("+15550100") == (True, "1")
+    assert cache.stats()['size'] == 2
+
+
+def test_expired_entry_is_a_miss():
+    cache = ContactCache(ttl=0.05)
+    cache.put("+15550100", "7")
+    assert cache.peek("+15550100") == (True, "7")
+
+    time.sleep(0.1)
+    assert cache.peek("+15550100") == (False, None)
+    assert cache.stats()['misses'] == 1
+
+
+def test_no_contact_is_cached_for_the_negative_ttl():
+    cache = ContactCache(ttl=3600, negative_ttl=0.05)
+    cache.put("+15550100", None)
+    assert cache.peek("+15550100") == (True, None)
+    assert cache.stats()['negative_hits'] == 1
+
+    time.sleep(0.1)
+    assert cache.peek("+15550100") == (False, None)
+
+
+def test_shared_store_hit_in_another_process(tmp_path):
+    path = str(tmp_path / "contacts.db")
+    ContactCache(store=SqliteContactStore(path)).put("+15550100", "7")
+
+    other = ContactCache(store=SqliteContactStore(path))
+    assert other.peek("+15550100") == (True, "7")
+    assert other.stats()['store_hits'] == 1
+
+
+def test_only_one_process_holds_the_create_lease(tmp_path):
+    path = str(tmp_path / "contacts.db")
+    first = ContactCache(store=SqliteContactStore(path))
+    second = ContactCache(store=SqliteContactStore(path))
+    assert first.begin_create("+15550100")
+    assert not second.begin_create("+15550100")
+
+    # Once the lease holder has created the contact, the other process picks up its ID
+    second.put("+15550100", None)
+    first.put("+15550100", "42")
+    assert second.peek("+15550100") == (True, None)
+    assert second.refresh("+15550100") == (True, "42")
+    assert not second.begin_create("+15550100")
+
+
+def test_failed_create_releases_the_lease(tmp_path):
+    path = str(tmp_path / "contacts.db")
+    first = ContactCache(store=SqliteContactStore(path))
+    assert first.begin_create("+15550100")
+    first.abort_create("+15550100")
+    assert ContactCache(store=SqliteContactStore(path)).begin_create("+15550100")
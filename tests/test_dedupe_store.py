@@ -0,0 +1,87 @@
+import time
+
+import pytest
+
+from dedupe_store import BUCKET_MS, DedupeStore, ExpirySweeper, MemoryDedupeStore, SqliteDedupeStore
+
+
+def test_base_store_cannot_be_instantiated():
+    with pytest.raises(TypeError):
+        DedupeStore()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryDedupeStore(max_per_number=2)
+    else:
+        store = SqliteDedupeStore(str(tmp_path / "processed_calls.db"), max_per_number=2)
+        yield store
+        store.close()
+
+
+def test_claim_recognises_related_sids(store):
+    assert store.claim("+15550100", "CA1", ["CL1"], timestamp=1000)
+    assert not store.claim("+15550100", "CL1", timestamp=1000)
+    assert store.is_processed("CL1")
+    store.release("CA1")
+    assert not store.is_processed("CA1", "CL1")
+
+
+def test_cap_and_expiry(store):
+    for n in range(3):
+        assert store.claim("+15550100", f"CA{n}", timestamp=n * BUCKET_MS + 1)
+    assert store.count() == 2
+    assert not store.is_processed("CA0")
+    assert store.expire(cutoff_timestamp=2 * BUCKET_MS) == 1
+    assert store.count() == 1
+
+
+class RecordingTarget:
+    """Stands in for the call correlator: hands out its expired rows in batches."""
+
+    def __init__(self, expired):
+        self.expired = expired
+        self.calls = []
+
+    def expire(self, cutoff_timestamp, limit=500):
+        self.calls.append((cutoff_timestamp, limit))
+        removed = min(self.expired, limit)
+        self.expired -= removed
+        return removed
+
+
+def test_sweep_expires_old_records_in_batches(store):
+    now = int(time.time() * 1000)
+    old = now - 8 * 24 * 60 * 60 * 1000
+    for n in range(5):
+        assert store.claim(f"+1555010{n}", f"CA{n}", timestamp=old + n)
+    assert store.claim("+15550199", "CA-new", timestamp=now)
+    correlator = RecordingTarget(expired=3)
+
+    sweeper = ExpirySweeper(store, retention_days=7, batch_size=2, also_expire=[correlator])
+    assert sweeper.sweep() == 8
+    assert store.count() == 1
+    assert store.is_processed("CA-new")
+    # Full batches mean there may be more; the short one ends the loop
+    assert [limit for _, limit in correlator.calls] == [2, 2]
+    assert old + 4 <= correlator.calls[0][0] < now
+
+    assert sweeper.sweep() == 0
+    stats = sweeper.stats()
+    assert stats['sweeps'] == 2
+    assert stats['evicted_total'] == 8
+    assert stats['last_evicted'] == 0
+    assert stats['total_duration_seconds'] >= stats['last_duration_seconds']
+
+
+def test_only_one_process_holds_the_sweep_lease(tmp_path):
+    path = str(tmp_path / "processed_calls.db")
+    first, second = SqliteDedupeStore(path), SqliteDedupeStore(path)
+    assert first.acquire_sweep_lease(0.2)
+    assert not second.acquire_sweep_lease(0.2)
+    time.sleep(0.3)
+    assert second.acquire_sweep_lease(0.2)
+    assert not first.acquire_sweep_lease(0.2)
+    first.close()
+    second.close()
@@ -0,0 +1,163 @@
+import os
+import time
+
+import pytest
+
+from contact_cache import ContactCache, SqliteContactStore
+from hubspot_batcher import CallBatcher, _PendingCall
+from hubspot_client import HubSpotError
+
+
+class StubClient:
+    def __init__(self, batch_error=None, contact_error=None):
+        self.batch_error = batch_error
+        self.contact_error = contact_error
+        self.single_creates = 0
+        self.contact_creates = []
+
+    def search_contacts_by_phones(self, phones):
+        return {}
+
+    def batch_create_contacts(self, phones):
+        self.contact_creates.append(list(phones))
+        if self.contact_error:
+            raise self.contact_error
+        return {phone: f"contact-{phone}" for phone in phones}
+
+    def batch_create_calls(self, calls):
+        if self.batch_error:
+            raise self.batch_error
+        return {key: f"call-{key}" for key, _, _ in calls}
+
+    def create_call(self, contact_id, properties):
+        self.single_creates += 1
+        return f"single-{self.single_creates}"
+
+
+def batcher_for(client):
+    cache = ContactCache()
+    cache.put("+15550100", "7")
+    cache.put("+15550101", "8")
+    return CallBatcher(client, cache)
+
+
+def pending_calls():
+    return [_PendingCall("1", "+15550100", {}), _PendingCall("2", "+15550101", {})]
+
+
+def test_batch_writes_every_call():
+    batch = pending_calls()
+    batcher_for(StubClient())._flush(batch)
+    assert [pending.call_id for pending in batch] == ["call-1", "call-2"]
+
+
+def test_rejected_batch_falls_back_to_single_writes():
+    client = StubClient(HubSpotError("Failed to log calls: 400 - bad association", 400))
+    batch = pending_calls()
+    batcher_for(client)._flush(batch)
+    assert client.single_creates == 2
+    assert all(pending.call_id for pending in batch)
+
+
+def test_server_error_fails_the_batch_without_single_writes():
+    client = StubClient(HubSpotError("Failed to log calls: 502 - bad gateway", 502))
+    batch = pending_calls()
+    with pytest.raises(HubSpotError):
+        batcher_for(client)._flush(batch)
+    assert client.single_creates == 0
+    assert [pending.call_id for pending in batch] == [None, None]
+
+
+def test_failed_contact_create_releases_the_lease(tmp_path):
+    client = StubClient(contact_error=HubSpotError("Failed to create contacts: 502 - bad gateway", 502))
+    cache = ContactCache(store=SqliteContactStore(str(tmp_path / "contacts.db")))
+    batcher = CallBatcher(client, cache)
+
+    first = [_PendingCall("1", "+15550100", {})]
+    batcher._flush(first)
+    assert first[0].call_id is None
+
+    client.contact_error = None
+    retry = [_PendingCall("2", "+15550100", {})]
+    started = time.monotonic()
+    batcher._flush(retry)
+    assert time.monotonic() - started < 1
+    assert retry[0].call_id == "call-2"
+    assert client.contact_creates == [["+15550100"], ["+15550100"]]
+
+
+def test_number_leased_by_another_process_is_left_for_a_retry(tmp_path):
+    path = str(tmp_path / "contacts.db")
+    assert SqliteContactStore(path).acquire_create_lease("+15550100")
+    client = StubClient()
+    batcher = CallBatcher(client, ContactCache(store=SqliteContactStore(path)))
+
+    batch = [_PendingCall("1", "+15550100", {}), _PendingCall("2", "+15550101", {})]
+    started = time.monotonic()
+    batcher._flush(batch)
+    assert time.monotonic() - started < 1
+    assert [pending.call_id for pending in batch] == [None, "call-2"]
+    assert client.contact_creates == [["+15550101"]]
+
+
+def test_number_cached_without_a_contact_is_not_searched_again():
+    client = StubClient()
+    searched = []
+    client.search_contacts_by_phones = lambda phones: searched.append(list(phones)) or {}
+    cache = ContactCache()
+    cache.put("+15550100", None)
+
+    batch = [_PendingCall("1", "+15550100", {})]
+    CallBatcher(client, cache)._flush(batch)
+    assert searched == []
+    assert client.contact_creates == [["+15550100"]]
+    assert batch[0].call_id == "call-1"
+
+
+
+def test_search_without_a_match_is_cached_while_another_process_creates(tmp_path):
+    path = str(tmp_path / "contacts.db")
+    other = SqliteContactStore(path)
+    assert other.acquire_create_lease("+15550100")
+    client = StubClient()
+    batcher = CallBatcher(client, ContactCache(store=SqliteContactStore(path)))
+
+    batcher._flush([_PendingCall("1", "+15550100", {})])
+    assert batcher.contact_cache.peek("+15550100") == (True, None)
+
+    # The other process finishes; the retry picks its contact up without searching or creating
+    other.set("+15550100", "42", ttl=3600)
+    client.search_contacts_by_phones = lambda phones: pytest.fail("searched again")
+    retry = [_PendingCall("2", "+15550100", {})]
+    batcher._flush(retry)
+    assert retry[0].call_id == "call-2"
+    assert client.contact_creates == []
+
+
+def test_call_abandoned_after_a_timeout_is_not_written():
+    client = StubClient()
+    batcher = batcher_for(client)
+    # No batcher thread: the call just sits in the queue until log_call() gives up
+    batcher._started_pid = os.getpid()
+    assert batcher.log_call("+15550100", {}, timeout=0.01) is None
+
+    batch = [batcher._pending.get()]
+    batcher._flush(batch)
+    assert batch[0].call_id is None
+
+
+def test_timeout_waits_for_a_call_already_being_written():
+    pending = _PendingCall("1", "+15550100", {})
+    assert pending.start_writing()
+    assert not pending.abandon()
+
+
+def test_calls_from_the_same_number_share_one_search_and_create():
+    client = StubClient()
+    searched = []
+    client.search_contacts_by_phones = lambda phones: searched.append(sorted(phones)) or {}
+    batch = [_PendingCall("1", "+15550100", {}), _PendingCall("2", "+15550100", {})]
+    CallBatcher(client, ContactCache())._flush(batch)
+    assert searched == [["+15550100"]]
+    assert client.contact_creates == [["+15550100"]]
+    assert [pending.call_id for pending in batch] == ["call-1", "call-2"]
@@ -0,0 +1,108 @@
+import time
+
+import pytest
+
+from hubspot_client import HubSpotClient, HubSpotError, SharedTokenBucket
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.headers = {}
+        self.text = str(self.body)
+
+    def json(self):
+        return self.body
+
+
+def scripted_client(monkeypatch, *responses):
+    client = HubSpotClient("key", backoff_factor=0)
+    sent = []
+    responses = list(responses)
+
+    def send(method, url, operation, **kwargs):
+        sent.append((method, operation))
+        return responses.pop(0)
+
+    monkeypatch.setattr(client, "_send", send)
+    return client, sent
+
+
+def test_search_is_retried_after_server_error(monkeypatch):
+    found = FakeResponse(200, {'results': [{'id': '7', 'properties': {'phone': "+15550100"}}]})
+    client, sent = scripted_client(monkeypatch, FakeResponse(502), found)
+    assert client.search_contacts_by_phones(["+15550100"]) == {"+15550100": '7'}
+    assert len(sent) == 2
+
+
+def test_update_is_retried_after_server_error(monkeypatch):
+    client, sent = scripted_client(monkeypatch, FakeResponse(503), FakeResponse(200))
+    client.update_call("42", {"hs_call_status": "COMPLETED"})
+    assert sent == [('PATCH', 'update_call'), ('PATCH', 'update_call')]
+
+
+def test_create_is_not_resent_after_server_error(monkeypatch):
+    client, sent = scripted_client(monkeypatch, FakeResponse(502), FakeResponse(201, {'id': '9'}))
+    with pytest.raises(HubSpotError):
+        client.create_call("7", {"hs_call_from_number": "+15550100"})
+    assert len(sent) == 1
+
+
+def test_server_errors_give_up_after_retries(monkeypatch):
+    client, sent = scripted_client(monkeypatch, *[FakeResponse(500)] * 4)
+    with pytest.raises(HubSpotError):
+        client.search_contacts_by_phones(["+15550100"])
+    assert len(sent) == 4
+
+
+def test_batch_create_calls_matches_results_without_trace_ids(monkeypatch):
+    results = [{'id': str(100 + n), 'properties': {'hs_call_from_number': number}}
+               for n, number in enumerate(["+15550100", "+15550100", "+15550101"])]
+    client, sent = scripted_client(monkeypatch, FakeResponse(201, {'results': results}))
+    calls = [("a", "7", {"hs_call_from_number": "+15550100"}),
+             ("b", "7", {"hs_call_from_number": "+15550100"}),
+             ("c", "8", {"hs_call_from_number": "+15550101"})]
+    created = client.batch_create_calls(calls)
+    assert created["c"] == "102"
+    assert sorted(created) == ["a", "b", "c"]
+    assert sorted(created.values()) == ["100", "101", "102"]
+
+
+def test_batch_create_calls_returns_earlier_chunks_when_a_later_one_fails(monkeypatch):
+    first_chunk = [{'id': str(n), 'objectWriteTraceId': str(n)} for n in range(100)]
+    client, sent = scripted_client(monkeypatch, FakeResponse(201, {'results': first_chunk}), FakeResponse(502))
+    calls = [(str(n), "7", {"hs_call_from_number": f"+1555{n:07d}"}) for n in range(150)]
+    created = client.batch_create_calls(calls)
+    assert sorted(created, key=int) == [str(n) for n in range(100)]
+    assert len(sent) == 2
+
+
+def test_batch_create_calls_raises_when_nothing_was_written(monkeypatch):
+    client, sent = scripted_client(monkeypatch, FakeResponse(502))
+    with pytest.raises(HubSpotError) as error:
+        client.batch_create_calls([("a", "7", {"hs_call_from_number": "+15550100"})])
+    assert error.value.status_code == 502
+
+
+def test_shared_token_bucket_paces_every_process_using_the_file(tmp_path):
+    path = str(tmp_path / "rate_limit.db")
+    first = SharedTokenBucket(path, "default", rate_per_second=5, burst=2)
+    second = SharedTokenBucket(path, "default", rate_per_second=5, burst=2)
+    first.acquire()
+    first.acquire()
+
+    started = time.monotonic()
+    second.acquire()
+    assert time.monotonic() - started >= 0.15
+
+
+def test_shared_token_bucket_pause_applies_to_every_process(tmp_path):
+    path = str(tmp_path / "rate_limit.db")
+    first = SharedTokenBucket(path, "search", rate_per_second=100, burst=10)
+    second = SharedTokenBucket(path, "search", rate_per_second=100, burst=10)
+    first.pause(0.3)
+
+    started = time.monotonic()
+    second.acquire()
+    assert time.monotonic() - started >= 0.25
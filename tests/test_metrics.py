@@ -0,0 +1,88 @@
+import os
+import multiprocessing
+
+import pytest
+
+from metrics import Registry, EXITED_SNAPSHOT
+
+
+def new_registry(directory=None):
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests.", ["route"])
+    latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    depth = registry.gauge("queue_depth", "Depth.")
+    if directory:
+        registry.share(directory, interval=3600)
+    return registry, requests, latency, depth
+
+
+def sample(text, line_prefix):
+    return [line for line in text.splitlines() if line.startswith(line_prefix)]
+
+
+def test_renders_this_process_without_a_directory():
+    registry, requests, latency, depth = new_registry()
+    requests.inc(route="/voice")
+    latency.observe(0.5)
+    depth.set(3)
+    text = registry.render()
+    assert 'requests_total{route="/voice"} 1' in text
+    assert 'latency_seconds_bucket{le="1"} 1' in text
+    assert "queue_depth 3" in text
+
+
+def _record_in_child(directory, conn):
+    registry, requests, latency, depth = new_registry(directory)
+    registry.start()
+    requests.inc(2, route="/voice")
+    latency.observe(0.05)
+    depth.set(5)
+    registry._publish()
+    conn.send(os.getpid())
+    conn.recv()
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_adds_up_processes_sharing_a_directory(tmp_path):
+    context = multiprocessing.get_context("fork")
+    parent_conn, child_conn = context.Pipe()
+    child = context.Process(target=_record_in_child, args=(str(tmp_path), child_conn))
+    child.start()
+    parent_conn.recv()
+
+    registry, requests, latency, depth = new_registry(str(tmp_path))
+    registry.start()
+    requests.inc(route="/voice")
+    latency.observe(0.5)
+    depth.set(1)
+
+    text = registry.render()
+    assert 'requests_total{route="/voice"} 3' in text
+    assert sample(text, "latency_seconds_bucket") == [
+        'latency_seconds_bucket{le="0.1"} 1', 'latency_seconds_bucket{le="1"} 2', 'latency_seconds_bucket{le="+Inf"} 2']
+    assert "queue_depth 6" in text
+
+    # Once the child has exited its counts stay, but its gauge no longer adds up
+    parent_conn.send("exit")
+    child.join(10)
+    text = registry.render()
+    assert 'requests_total{route="/voice"} 3' in text
+    assert "queue_depth 1" in text
+
+    # ...and are folded into one file, so scrapes don't read a file per exited worker
+    assert {name for name in os.listdir(tmp_path) if name.endswith(".json")} == {
+        EXITED_SNAPSHOT, f"metrics.{os.getpid()}.json"}
+    assert 'requests_total{route="/voice"} 3' in registry.render()
+
+
+def test_reused_pid_does_not_overwrite_an_exited_process_counts(tmp_path):
+    # Left behind by an exited worker whose PID this process now has
+    (tmp_path / f"metrics.{os.getpid()}.json").write_text(
+        '{"requests_total": [[["/voice"], 4]], "queue_depth": [[[], 7]]}')
+
+    registry, requests, latency, depth = new_registry(str(tmp_path))
+    registry.start()
+    requests.inc(route="/voice")
+    text = registry.render()
+    assert 'requests_total{route="/voice"} 5' in text
+    assert "queue_depth 7" not in text
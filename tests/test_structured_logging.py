@@ -0,0 +1,27 @@
+import json
+import logging
+
+from structured_logging import JsonFormatter, TextFormatter
+
+
+def record_with_payload():
+    record = logging.LogRecord("root", logging.INFO, __file__, 1, "Voice endpoint request", None, None)
+    record.payload = {'CallSid': "CA1", 'From': "+15550100"}
+    return record
+
+
+def test_json_lines_include_extra_fields():
+    entry = json.loads(JsonFormatter().format(record_with_payload()))
+    assert entry['message'] == "Voice endpoint request"
+    assert entry['payload'] == {'CallSid': "CA1", 'From': "+15550100"}
+
+
+def test_text_lines_include_extra_fields():
+    line = TextFormatter().format(record_with_payload())
+    assert " - INFO - Voice endpoint request " in line
+    assert line.endswith('{"payload": {"CallSid": "CA1", "From": "+15550100"}}')
+
+
+def test_text_lines_without_extra_fields_are_unchanged():
+    record = logging.LogRecord("root", logging.INFO, __file__, 1, "Loaded technician routing", None, None)
+    assert TextFormatter().format(record).endswith(" - INFO - Loaded technician routing")
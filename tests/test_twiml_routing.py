@@ -0,0 +1,87 @@
+from datetime import datetime
+
+import pytest
+
+from twiml_routing import (
+    AFTER_HOURS, BUSINESS, RoutingConfigError, build_routing_table, parse_business_days, parse_business_hours
+)
+
+TECHNICIANS = "+15555550100,+15555550101"
+
+
+def test_parse_business_hours():
+    assert parse_business_hours("") is None
+    assert parse_business_hours("08:00-18:30") == (480, 1110)
+    assert parse_business_hours(" 22:00-6:00 ") == (1320, 360)
+
+
+@pytest.mark.parametrize("value", ["25:00-99:99", "08:60-18:00", "08:00-24:00", "8-18", "08:00"])
+def test_parse_business_hours_rejects_invalid_times(value):
+    with pytest.raises(RoutingConfigError):
+        parse_business_hours(value)
+
+
+def test_parse_business_days():
+    assert parse_business_days("") == {0, 1, 2, 3, 4}
+    assert parse_business_days("mon,wed, fri") == {0, 2, 4}
+    assert parse_business_days("fri-mon") == {4, 5, 6, 0}
+    with pytest.raises(RoutingConfigError):
+        parse_business_days("mon-funday")
+
+
+def test_variant_follows_business_hours_and_days():
+    table = build_routing_table({
+        'technician_numbers': TECHNICIANS,
+        'after_hours_numbers': "+15555550199",
+        'business_hours': "08:00-18:00",
+        'business_days': "mon-fri",
+    })
+    # 2026-10-16 is a Friday
+    assert table.variant_name(datetime(2026, 10, 16, 8, 0)) == BUSINESS
+    assert table.variant_name(datetime(2026, 10, 16, 18, 0)) == AFTER_HOURS
+    assert table.variant_name(datetime(2026, 10, 17, 12, 0)) == AFTER_HOURS
+    assert b"+15555550199" in table.initial(datetime(2026, 10, 17, 12, 0))
+    assert b"+15555550100" in table.initial(datetime(2026, 10, 16, 12, 0))
+
+
+def test_overnight_business_hours_wrap_past_midnight():
+    table = build_routing_table({'technician_numbers': TECHNICIANS, 'business_hours': "22:00-06:00",
+                                 'business_days': "mon-sun"})
+    assert table.variant_name(datetime(2026, 10, 16, 23, 0)) == BUSINESS
+    assert table.variant_name(datetime(2026, 10, 16, 5, 59)) == BUSINESS
+    assert table.variant_name(datetime(2026, 10, 16, 12, 0)) == AFTER_HOURS
+
+
+def test_without_business_hours_every_call_uses_the_technicians():
+    table = build_routing_table({'technician_numbers': TECHNICIANS})
+    assert table.variant_name(datetime(2026, 10, 18, 3, 0)) == BUSINESS
+
+
+def test_simultaneous_ring_dials_everyone_in_one_step():
+    table = build_routing_table({'technician_numbers': TECHNICIANS})
+    twiml = table.initial()
+    assert b"+15555550100" in twiml and b"+15555550101" in twiml
+    assert table.step(BUSINESS, 1) is None
+    assert table.is_last_step(BUSINESS, 0)
+
+
+def test_sequential_ring_has_a_step_per_technician():
+    table = build_routing_table({'technician_numbers': TECHNICIANS, 'ring_mode': "sequential"})
+    first, second = table.step(BUSINESS, 0), table.step(BUSINESS, 1)
+    assert b"+15555550100" in first and b"+15555550101" not in first
+    assert b"+15555550101" in second
+    assert b"step=1" in second
+    assert table.step(BUSINESS, 2) is None
+    assert not table.is_last_step(BUSINESS, 0)
+    assert table.is_last_step(BUSINESS, 1)
+
+
+@pytest.mark.parametrize("config", [
+    {},
+    {'technician_numbers': "5550100"},
+    {'technician_numbers': TECHNICIANS, 'ring_mode': "round-robin"},
+    {'technician_numbers': TECHNICIANS, 'business_hours': "25:00-99:99"},
+])
+def test_invalid_routing_is_rejected(config):
+    with pytest.raises(RoutingConfigError):
+        build_routing_table(config)
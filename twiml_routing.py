@@ -0,0 +1,258 @@
+import os
+import re
+import json
+import time
+import signal
+import logging
+import threading
+from datetime import datetime
+from dotenv import load_dotenv
+from twilio.twiml.voice_response import VoiceResponse, Dial
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9
+    ZoneInfo = None
+
+E164_PATTERN = re.compile(r'^\+\d{10,15}$')
+
+# Dial settings; simultaneous ring matches the original single <Dial>
+DIAL_TIMEOUT = 30
+DIAL_TIME_LIMIT = 600
+SEQUENTIAL_RING_TIMEOUT = 20
+
+RING_MODES = ("simultaneous", "sequential")
+BUSINESS = "business"
+AFTER_HOURS = "after_hours"
+DAY_NAMES = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+# How often the routing file's modification time is checked
+FILE_CHECK_INTERVAL = 5.0
+
+
+class RoutingConfigError(ValueError):
+    """Raised when the technician routing configuration is invalid."""
+
+
+def parse_numbers(value, name):
+    if isinstance(value, str):
+        value = value.split(",")
+    numbers = [num.strip() for num in value or [] if num.strip()]
+    invalid = [num for num in numbers if not E164_PATTERN.match(num)]
+    if invalid:
+        raise RoutingConfigError(f"Invalid {name}: {', '.join(invalid)}")
+    return numbers
+
+
+def parse_business_hours(value):
+    """Parse "HH:MM-HH:MM" into (start_minute, end_minute); empty means always business hours."""
+    if not value:
+        return None
+    match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$', value.strip())
+    if not match:
+        raise RoutingConfigError(f"Invalid business hours: {value}")
+    h1, m1, h2, m2 = (int(part) for part in match.groups())
+    if h1 >= 24 or h2 >= 24 or m1 >= 60 or m2 >= 60:
+        raise RoutingConfigError(f"Invalid business hours: {value}")
+    return h1 * 60 + m1, h2 * 60 + m2
+
+
+def parse_business_days(value):
+    """Parse "mon-fri" or "mon,wed,fri" into a set of weekday numbers."""
+    days = set()
+    for part in (value or "mon-fri").lower().split(","):
+        part = part.strip()
+        try:
+            if "-" in part:
+                start, end = (DAY_NAMES.index(day.strip()) for day in part.split("-"))
+                days.update(range(start, end + 1) if start <= end else [*range(start, 7), *range(0, end + 1)])
+            elif part:
+                days.add(DAY_NAMES.index(part))
+        except ValueError:
+            raise RoutingConfigError(f"Invalid business days: {value}")
+    return days
+
+
+def render_dial(numbers, action, status_callback, timeout):
+    resp = VoiceResponse()
+    dial = Dial(
+        timeout=timeout,
+        timeLimit=DIAL_TIME_LIMIT,
+        action=action,
+        method="POST"
+    )
+    for tn in numbers:
+        dial.number(
+            tn,
+            status_callback_event="completed",
+            status_callback=status_callback,
+            status_callback_method="POST"
+        )
+    resp.append(dial)
+    return str(resp).encode()
+
+
+def render_variant(name, numbers, ring_mode):
+    """Pre-render the TwiML steps for one routing variant.
+
+    Simultaneous ring is a single step that dials everyone. Sequential ring has one step per
+    technician; the step index travels on the callback URLs so /call-status can serve the next one.
+    """
+    if ring_mode == "simultaneous":
+        return (render_dial(numbers, "/call-status", "/call-completed", DIAL_TIMEOUT),)
+    return tuple(
+        render_dial(
+            [tn],
+            f"/call-status?route={name}&step={i}",
+            f"/call-completed?route={name}&step={i}",
+            SEQUENTIAL_RING_TIMEOUT
+        )
+        for i, tn in enumerate(numbers)
+    )
+
+
+class RoutingTable:
+    """Immutable, pre-rendered TwiML for every routing variant."""
+
+    def __init__(self, variants, business_hours=None, business_days=None, timezone=None):
+        self.variants = variants
+        self.business_hours = business_hours
+        self.business_days = business_days
+        self.timezone = timezone
+
+    def variant_name(self, now=None):
+        if self.business_hours is None:
+            return BUSINESS
+        now = now or datetime.now(self.timezone)
+        minute = now.hour * 60 + now.minute
+        start, end = self.business_hours
+        in_hours = start <= minute < end if start <= end else (minute >= start or minute < end)
+        return BUSINESS if in_hours and now.weekday() in self.business_days else AFTER_HOURS
+
+    def initial(self, now=None):
+        """TwiML bytes for a new inbound call."""
+        return self.variants[self.variant_name(now)][0]
+
+    def step(self, name, index):
+        """TwiML bytes for a sequential-ring step, or None if there is no such step."""
+        steps = self.variants.get(name)
+        if steps is None or index < 0 or index >= len(steps):
+            return None
+        return steps[index]
+
+    def is_last_step(self, name, index):
+        steps = self.variants.get(name)
+        return steps is None or index >= len(steps) - 1
+
+
+def load_routing_config(routing_file=None):
+    """Collect routing settings from the environment, overridden by the optional JSON routing file."""
+    config = {
+        'technician_numbers': os.getenv("TECHNICIAN_NUMBERS", ""),
+        'after_hours_numbers': os.getenv("AFTER_HOURS_NUMBERS", ""),
+        'business_hours': os.getenv("BUSINESS_HOURS", ""),
+        'business_days': os.getenv("BUSINESS_DAYS", "mon-fri"),
+        'timezone': os.getenv("BUSINESS_TIMEZONE", ""),
+        'ring_mode': os.getenv("RING_MODE", "simultaneous"),
+        'after_hours_ring_mode': os.getenv("AFTER_HOURS_RING_MODE", "")
+    }
+    if routing_file and os.path.exists(routing_file):
+        try:
+            with open(routing_file, 'r') as f:
+                config.update(json.load(f))
+        except (OSError, ValueError) as e:
+            raise RoutingConfigError(f"Could not read routing file {routing_file}: {e}")
+    return config
+
+
+def build_routing_table(config):
+    technicians = parse_numbers(config.get('technician_numbers'), "technician numbers")
+    if not technicians:
+        raise RoutingConfigError("No technician numbers configured")
+    after_hours = parse_numbers(config.get('after_hours_numbers'), "after-hours numbers") or technicians
+
+    ring_mode = (config.get('ring_mode') or "simultaneous").lower()
+    after_hours_ring_mode = (config.get('after_hours_ring_mode') or ring_mode).lower()
+    for mode in (ring_mode, after_hours_ring_mode):
+        if mode not in RING_MODES:
+            raise RoutingConfigError(f"Invalid ring mode: {mode}")
+
+    timezone = None
+    if config.get('timezone'):
+        if ZoneInfo is None:
+            raise RoutingConfigError("BUSINESS_TIMEZONE requires Python 3.9+")
+        try:
+            timezone = ZoneInfo(config['timezone'])
+        except Exception:
+            raise RoutingConfigError(f"Unknown timezone: {config['timezone']}")
+
+    return RoutingTable(
+        {
+            BUSINESS: render_variant(BUSINESS, technicians, ring_mode),
+            AFTER_HOURS: render_variant(AFTER_HOURS, after_hours, after_hours_ring_mode)
+        },
+        business_hours=parse_business_hours(config.get('business_hours')),
+        business_days=parse_business_days(config.get('business_days')),
+        timezone=timezone
+    )
+
+
+class RoutingCache:
+    """Holds the current RoutingTable and swaps in a new one when the configuration changes.
+
+    The routing file's mtime is checked at most every FILE_CHECK_INTERVAL seconds, and SIGHUP
+    requests a reload of both .env and the routing file. A bad configuration is logged and the
+    previous table keeps serving.
+    """
+
+    def __init__(self, routing_file=None):
+        self.routing_file = routing_file
+        self.table = None
+        self._mtime = None
+        self._next_check = 0.0
+        self._reload_requested = False
+        self._lock = threading.Lock()
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.routing_file).st_mtime if self.routing_file else None
+        except OSError:
+            return None
+
+    def reload(self, reread_env=False):
+        """Rebuild the table from current configuration. Returns True if it was replaced."""
+        with self._lock:
+            if reread_env:
+                load_dotenv(override=True)
+            mtime = self._file_mtime()
+            try:
+                table = build_routing_table(load_routing_config(self.routing_file))
+            except RoutingConfigError as e:
+                logging.error(f"Invalid technician routing, keeping previous configuration: {e}")
+                self._mtime = mtime
+                return False
+            self.table = table
+            self._mtime = mtime
+            logging.info("Loaded technician routing")
+            return True
+
+    def current(self):
+        """Return the current table, reloading first if a reload is due. None if never valid."""
+        if self._reload_requested:
+            self._reload_requested = False
+            self.reload(reread_env=True)
+        elif self.routing_file and time.monotonic() >= self._next_check:
+            self._next_check = time.monotonic() + FILE_CHECK_INTERVAL
+            if self._file_mtime() != self._mtime:
+                self.reload()
+        return self.table
+
+    def install_reload_signal(self):
+        """Reload on SIGHUP. Only possible from the main thread and on platforms with SIGHUP."""
+        def request_reload(signum, frame):
+            self._reload_requested = True
+
+        try:
+            signal.signal(signal.SIGHUP, request_reload)
+        except (AttributeError, ValueError):
+            pass